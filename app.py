@@ -1,20 +1,35 @@
 # -*- coding: utf-8 -*-
 import streamlit as st
 import pandas as pd
+import numpy as np
 import folium
 from folium.plugins import Draw
+from folium.utilities import JsCode
 from streamlit_folium import st_folium
 import html
+import json
+import re
 import sys
-import base64
+import os
+import hashlib
+import importlib.util
 import io
+import operator
+import gzip
+import bz2
+import lzma
+import zipfile
 import traceback
+import time
+import contextlib
+import collections
+import datetime
 
 # --- Configuración Inicial de la Página Streamlit ---
 st.set_page_config(layout="wide", page_title="Mapa Interactivo Establecimientos")
 st.title("🗺️ Mapa Interactivo de Establecimientos Educacionales")
 st.markdown("""
-Sube tu archivo Excel ('Base Datos (EB).xlsx' o similar) para visualizar los establecimientos.
+Sube tu archivo Excel ('Base Datos (EB).xlsx' o similar), CSV o Parquet para visualizar los establecimientos.
 Puedes usar los filtros en la barra lateral para refinar la selección.
 """)
 
@@ -25,8 +40,13 @@ COLS_INTERES = [
     'MAT_TOTAL','LATITUD','LONGITUD'
 ]
 COLS_CRITICAS = ['LATITUD', 'LONGITUD', 'RBD']
+COLS_TEXTO = ['NOM_RBD', 'ENS_01', 'ENS_02', 'ENS_03', 'ENS_04', 'ENS_05', 'ENS_06']  # Se leen como texto; el resto se coerciona al limpiar
+PROGRAMAS = ['PIE', 'PACE', 'PIE y PACE', 'Otros']
+COLS_ENS = [f'ENS_0{i}' for i in range(1, 7)]
+ENS_INACTIVOS = ['0', 'N/A', '']
 COLORS = {'PIE': '#E41A1C', 'PACE': '#377EB8', 'PIE y PACE': '#984EA3', 'Otros': '#4daf4a'}
 DEFAULT_COLOR = '#808080'
+PALETA_MARCADORES = list(COLORS.values()) + [DEFAULT_COLOR]  # Orden de los índices de color en los popups diferidos
 FONT_FAMILY = "'Segoe UI', Tahoma, Geneva, Verdana, sans-serif"
 DEFAULT_LAT = -33.45
 DEFAULT_LON = -70.67
@@ -46,13 +66,194 @@ MARKER_EXPONENT_CALC = 0.4 # Exponente para MAT_TOTAL (sensibilidad) (antes 0.35
 MARKER_DIVISOR_CALC = 2.5  # Divisor para MAT_TOTAL (escala) (antes 3)
 # --- FIN Constantes para el Radio ---
 
-@st.cache_data
-def load_and_process_data(uploaded_file_obj):
+# --- Constantes para Agrupamiento por Zoom (clusters) ---
+CLUSTER_MIN_ZOOM = 3            # Zoom más bajo con jerarquía precalculada
+CLUSTER_MAX_ZOOM = 15           # Desde este zoom siempre se dibujan puntos individuales
+CLUSTER_CELDA_PX = 64           # Lado de la celda de agrupamiento, en píxeles de pantalla
+MAX_PUNTOS_INDIVIDUALES = 2000  # Sobre este número de puntos en pantalla se agrupa
+MAP_HEIGHT_PX = 600
+MAP_WIDTH_PX_ESTIMADO = 1200    # Ancho supuesto del mapa cuando aún no llegan los bounds del navegador
+CLUSTER_COLOR = '#3186cc'
+DENSIDAD_COLORES = ['#ffffb2', '#fecc5c', '#fd8d3c', '#f03b20', '#bd0026']  # Celdas de densidad, de menos a más colegios
+PROGRAMAS_DENSIDAD = ['PIE', 'PACE', 'PIE y PACE']  # Mezcla de programas que se suma por celda
+MODOS_AGRUPAMIENTO = {'clusters': "Clusters", 'densidad': "Densidad (grilla)", 'ninguno': "Sin agrupar"}
+# --- FIN Constantes para Agrupamiento ---
+
+# --- Constantes para el Índice Espacial ---
+INDICE_CELDA_GRADOS = 0.05      # Lado de la celda de la grilla del índice (~5.5 km en latitud)
+RADIO_TIERRA_KM = 6371.0088
+DIBUJO_COLOR = '#ff7800'
+# --- FIN Constantes para el Índice Espacial ---
+
+# --- Constantes para la Caché en Disco ---
+CACHE_DIR = os.environ.get("MAPA_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache_mapa"))
+CACHE_MAX_MB = float(os.environ.get("MAPA_CACHE_MAX_MB", 500))  # Tope total; se expulsan los archivos menos usados
+CACHE_FORMATO_VERSION = 3  # Subir cuando cambie el frame que produce procesar_archivo
+# --- FIN Constantes para la Caché en Disco ---
+
+# --- Constantes para el Registro Compartido de Datasets ---
+REGISTRO_MAX_DATASETS = int(os.environ.get('MAPA_REGISTRO_MAX_DATASETS', 4))  # Archivos distintos en memoria a la vez (por proceso)
+# --- FIN Constantes para el Registro Compartido ---
+
+# --- Constantes para la Ingesta de Archivos ---
+TIPOS_ARCHIVO = ["xlsx", "xls", "csv", "gz", "bz2", "xz", "zip", "parquet"]
+COMPRESIONES_CSV = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.zip': 'zip'}
+MOTOR_EXCEL_RAPIDO_DISPONIBLE = importlib.util.find_spec("python_calamine") is not None
+# --- FIN Constantes para la Ingesta ---
+
+# --- Constantes para la Exportación ---
+FORMATOS_EXPORTACION = {  # formato: (etiqueta, extensión, MIME)
+    'xlsx': ("Excel (.xlsx)", 'xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': ("CSV", 'csv', 'text/csv'),
+    'parquet': ("Parquet", 'parquet', 'application/vnd.apache.parquet'),
+    'geojson': ("GeoJSON", 'geojson', 'application/geo+json'),
+}
+EXPORT_XLSX_FILAS_WRITE_ONLY = 5000  # Sobre este número de filas el Excel se escribe en modo write-only
+COLS_INTERNAS_EXPORTACION = ['ENS_ACTIVAS']  # Columnas derivadas que no se entregan al usuario
+# --- FIN Constantes para la Exportación ---
+
+# --- Constantes para el Perfilado ---
+PERFIL_MAX_REGISTROS = 5000  # Mediciones conservadas por sesión (las más antiguas se descartan)
+PERFIL_ETAPAS = ['lectura', 'limpieza', 'carga', 'indices', 'filtros', 'marcadores', 'serializacion', 'render', 'rerun_total', 'fragmento_mapa']
+# --- FIN Constantes para el Perfilado ---
+
+# --- Ingesta: sólo las columnas de COLS_INTERES, en streaming cuando el formato lo permite ---
+def _filas_excel_openpyxl(archivo):
+    import openpyxl
+    wb = openpyxl.load_workbook(archivo, read_only=True, data_only=True)
+    try:
+        yield from wb.worksheets[0].iter_rows(values_only=True)
+    finally:
+        wb.close()
+
+def _filas_excel_calamine(archivo):
+    from python_calamine import CalamineWorkbook
+    wb = CalamineWorkbook.from_filelike(archivo)
+    for fila in wb.get_sheet_by_index(0).iter_rows():
+        # calamine entrega '' en celdas vacías y float en toda celda numérica; los enteros vuelven a int como en openpyxl.
+        yield tuple(None if v == '' else int(v) if isinstance(v, float) and v.is_integer() else v for v in fila)
+
+def _leer_excel_columnas(archivo, motor):
+    filas = _filas_excel_calamine(archivo) if motor == 'calamine' else _filas_excel_openpyxl(archivo)
+    encabezado = [str(c).strip() if c is not None else '' for c in next(filas, ())]
+    posiciones = {}
+    for i, col in enumerate(encabezado):
+        if col in COLS_INTERES and col not in posiciones: posiciones[col] = i
+    if not posiciones: return pd.DataFrame(columns=encabezado)
+    columnas = list(posiciones); ancho = max(posiciones.values()) + 1
+    tomar = operator.itemgetter(*posiciones.values())
+    registros = []
+    for fila in filas:
+        if len(fila) < ancho: fila = tuple(fila) + (None,) * (ancho - len(fila))
+        registros.append(tomar(fila))
+    if len(columnas) == 1: registros = [(r,) for r in registros]
+    return pd.DataFrame.from_records(registros, columns=columnas)
+
+def _detectar_separador(archivo, compresion):
+    archivo.seek(0)
+    if compresion == 'gzip': flujo = gzip.GzipFile(fileobj=archivo)
+    elif compresion == 'bz2': flujo = bz2.BZ2File(archivo)
+    elif compresion == 'xz': flujo = lzma.LZMAFile(archivo)
+    elif compresion == 'zip':
+        zf = zipfile.ZipFile(archivo); flujo = zf.open(zf.namelist()[0])
+    else: flujo = archivo
+    primera_linea = flujo.readline(65536).decode('latin-1')
+    archivo.seek(0)
+    # Los archivos del Mineduc vienen con ';' y coma decimal; los exportados a mano, con ','.
+    return (';', ',') if primera_linea.count(';') > primera_linea.count(',') else (',', '.')
+
+def _leer_csv(archivo, compresion):
+    sep, decimal = _detectar_separador(archivo, compresion)
+    kwargs = dict(sep=sep, decimal=decimal, compression=compresion, usecols=lambda c: c in COLS_INTERES,
+                  dtype={c: str for c in COLS_TEXTO}, low_memory=False)
+    try:
+        return pd.read_csv(archivo, encoding='utf-8-sig', **kwargs)
+    except UnicodeDecodeError:
+        archivo.seek(0)
+        return pd.read_csv(archivo, encoding='latin-1', **kwargs)
+
+def _leer_parquet(archivo):
+    import pyarrow.parquet as pq
+    archivo_pq = pq.ParquetFile(archivo)
+    columnas = [c for c in COLS_INTERES if c in archivo_pq.schema_arrow.names]
+    return archivo_pq.read(columns=columnas).to_pandas()
+
+def leer_archivo_establecimientos(archivo, nombre=None, motor_excel=None):
+    """Lee Excel, CSV (opcionalmente comprimido) o Parquet devolviendo sólo las columnas de COLS_INTERES presentes."""
+    nombre = (nombre or getattr(archivo, 'name', '')).lower()
+    extension = os.path.splitext(nombre)[1]
+    if extension in COMPRESIONES_CSV: return _leer_csv(archivo, COMPRESIONES_CSV[extension])
+    if extension == '.csv': return _leer_csv(archivo, None)
+    if extension == '.parquet': return _leer_parquet(archivo)
+    if extension == '.xls': return pd.read_excel(archivo, usecols=lambda c: c in COLS_INTERES, dtype={c: str for c in COLS_TEXTO})
+    if motor_excel is None: motor_excel = 'calamine' if MOTOR_EXCEL_RAPIDO_DISPONIBLE else 'openpyxl'
+    return _leer_excel_columnas(archivo, motor_excel)
+
+# --- Caché persistente de archivos procesados (Parquet, clave = digest del contenido) ---
+def calcular_digest(uploaded_file_obj):
+    h = hashlib.sha256()
+    uploaded_file_obj.seek(0)
+    for bloque in iter(lambda: uploaded_file_obj.read(1 << 20), b''): h.update(bloque)
+    uploaded_file_obj.seek(0)
+    return h.hexdigest()
+
+def _ruta_cache(file_digest):
+    return os.path.join(CACHE_DIR, f"{file_digest}-v{CACHE_FORMATO_VERSION}.parquet")
+
+def leer_cache_disco(file_digest):
+    ruta = _ruta_cache(file_digest)
+    if not os.path.exists(ruta): return None
+    try:
+        df = pd.read_parquet(ruta, memory_map=True)  # Lectura mapeada: sin búfer intermedio con el archivo completo
+        os.utime(ruta)  # La fecha de modificación marca el último uso para la expulsión LRU
+        return df
+    except Exception as e:
+        print(f"WARN: caché en disco ilegible ({ruta}): {e}. Se reprocesa el archivo.")
+        return None
+
+def _expulsar_cache_lru(max_bytes):
+    try:
+        entradas = [os.path.join(CACHE_DIR, f) for f in os.listdir(CACHE_DIR) if f.endswith('.parquet')]
+        entradas = sorted(((os.path.getmtime(r), os.path.getsize(r), r) for r in entradas), reverse=True)
+    except OSError as e:
+        print(f"WARN: no se pudo revisar la caché en disco: {e}"); return
+    total = 0
+    for i, (_, tamano, ruta) in enumerate(entradas):
+        total += tamano
+        if i > 0 and total > max_bytes:  # La entrada recién usada se conserva aunque supere el tope por sí sola
+            try: os.remove(ruta); print(f"FN CACHE: expulsado de la caché en disco {os.path.basename(ruta)}")
+            except OSError as e: print(f"WARN: no se pudo expulsar {ruta}: {e}")
+
+def guardar_cache_disco(file_digest, df):
+    ruta = _ruta_cache(file_digest); ruta_tmp = f"{ruta}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        df.to_parquet(ruta_tmp, index=False)
+        os.replace(ruta_tmp, ruta)  # Escritura atómica: otra sesión nunca ve un Parquet a medio escribir
+    except Exception as e:
+        print(f"WARN: no se pudo guardar la caché en disco ({ruta}): {e}")
+        if os.path.exists(ruta_tmp): os.remove(ruta_tmp)
+        return
+    _expulsar_cache_lru(CACHE_MAX_MB * 1024 * 1024)
+
+def load_and_process_data(uploaded_file_obj, file_digest):
+    # Sin caché propia: la llama obtener_dataset, que guarda una sola copia por digest para todo el proceso.
+    df_cache = leer_cache_disco(file_digest)
+    if df_cache is not None:
+        print(f"FN CACHE: {uploaded_file_obj.name} cargado desde caché en disco ({file_digest[:12]}). {len(df_cache)} filas.")
+        return df_cache
+    df_processed = procesar_archivo(uploaded_file_obj)
+    if df_processed is not None and not df_processed.empty: guardar_cache_disco(file_digest, df_processed)
+    return df_processed
+
+def procesar_archivo(uploaded_file_obj):
     file_name = uploaded_file_obj.name
     print(f"\n--- FN CACHE: Leyendo y procesando archivo: {file_name} ---")
     try:
-        df = pd.read_excel(uploaded_file_obj)
-        print(f"FN CACHE: Archivo leído. {len(df)} filas iniciales.")
+        with medir_etapa('lectura') as medicion:
+            df = leer_archivo_establecimientos(uploaded_file_obj, file_name); medicion['filas'] = len(df)
+        inicio_limpieza = time.perf_counter()
+        print(f"FN CACHE: Archivo leído. {len(df)} filas iniciales, {len(df.columns)} columnas de interés.")
 
         missing_critical = [col for col in COLS_CRITICAS if col not in df.columns]
         if missing_critical:
@@ -64,287 +265,1020 @@ def load_and_process_data(uploaded_file_obj):
             cols_a_usar = [col for col in COLS_INTERES if col in df.columns]
         else:
             cols_a_usar = COLS_INTERES
-        cols_finales = list(set(cols_a_usar + COLS_CRITICAS))
+        cols_finales = cols_a_usar + [col for col in COLS_CRITICAS if col not in cols_a_usar]
         try:
             df_processed = df[cols_finales].copy()
         except KeyError as e:
              st.error(f"Error ({file_name}) seleccionando columnas iniciales: {e}.")
              return None
-        df_processed['LATITUD'] = pd.to_numeric(df_processed['LATITUD'], errors='coerce')
-        df_processed['LONGITUD'] = pd.to_numeric(df_processed['LONGITUD'], errors='coerce')
+        # Las columnas de texto quedan como str sin importar el formato o motor de lectura (un NOM_RBD numérico
+        # dejaría una columna de tipos mezclados que Parquet no puede guardar).
+        for col in COLS_TEXTO:
+            if col in df_processed.columns:
+                df_processed[col] = df_processed[col].where(df_processed[col].isna(), df_processed[col].astype(str))
+        df_processed['LATITUD'] = pd.to_numeric(df_processed['LATITUD'], errors='coerce').astype(np.float32)
+        df_processed['LONGITUD'] = pd.to_numeric(df_processed['LONGITUD'], errors='coerce').astype(np.float32)
         initial_rows = len(df_processed)
         df_processed.dropna(subset=['LATITUD', 'LONGITUD'], inplace=True)
         dropped_rows = initial_rows - len(df_processed)
         if dropped_rows > 0:
              print(f"FN CACHE WARN ({file_name}): Dropped {dropped_rows} rows due to invalid coordinates.")
-        if 'RBD' in df_processed.columns:
-             df_processed['RBD'] = pd.to_numeric(df_processed['RBD'], errors='coerce').fillna(0).astype(int)
-
-        for col in ['CONVENIO_PIE', 'PACE', 'MAT_TOTAL']:
-            if col in df_processed.columns:
-                df_processed.loc[:, col] = pd.to_numeric(df_processed[col], errors='coerce').fillna(0).astype(int)
-
-        for i in range(1, 7):
-             col_name = f'ENS_0{i}'
-             if col_name in df_processed.columns:
-                 df_processed.loc[:, col_name] = df_processed[col_name].astype(str)
-
         if df_processed.empty:
             st.error(f"({file_name}) No quedan datos válidos con coordenadas tras limpieza.")
             return None
+
+        # Limpieza columnar: cada columna se convierte una sola vez a su tipo compacto definitivo.
+        if 'RBD' in df_processed.columns:
+             df_processed['RBD'] = _a_entero(df_processed['RBD'], np.int32)
+        for col, dtype in [('CONVENIO_PIE', np.int8), ('PACE', np.int8), ('MAT_TOTAL', np.int32)]:
+            if col in df_processed.columns:
+                df_processed[col] = _a_entero(df_processed[col], dtype)
+        for col in ['COD_DEPE', 'COD_DEPE2']:
+            if col in df_processed.columns:
+                df_processed[col] = _compactar_codigo(df_processed[col])
+        if any(col in df_processed.columns for col in COLS_ENS):
+            df_processed['ENS_ACTIVAS'] = calcular_bits_ensenanzas(df_processed)
+            for col in COLS_ENS:
+                if col in df_processed.columns:
+                    df_processed[col] = _compactar_codigo(df_processed[col], solo_texto=True)
         if 'CONVENIO_PIE' in df_processed.columns or 'PACE' in df_processed.columns:
-             df_processed['programa'] = df_processed.apply(asignar_programa, axis=1)
+             df_processed['programa'] = asignar_programa(df_processed)
         else:
-            df_processed['programa'] = 'N/A'
+            df_processed['programa'] = pd.Categorical(['N/A'] * len(df_processed))
+        # Índice posicional: las estructuras precalculadas (clusters) se indexan por posición de fila.
+        df_processed.reset_index(drop=True, inplace=True)
+        registrar_etapa('limpieza', inicio_limpieza, filas=len(df_processed))
         print(f"--- FN CACHE: Procesamiento completado para {file_name}. {len(df_processed)} filas válidas. ---\n")
         return df_processed
     except Exception as e:
         st.error(f"Error crítico al procesar el archivo ({file_name}): {e}")
-        print(f"CRITICAL ERROR in load_and_process_data ({file_name}): {e}\n{traceback.format_exc()}")
+        print(f"CRITICAL ERROR in procesar_archivo ({file_name}): {e}\n{traceback.format_exc()}")
         return None
 
-def asignar_programa(row):
-    is_pie = row.get('CONVENIO_PIE', 0) == 1; is_pace = row.get('PACE', 0) == 1
-    if is_pie and is_pace: return 'PIE y PACE'
-    if is_pie: return 'PIE';
-    if is_pace: return 'PACE';
-    return 'Otros'
-
-def crear_popup_html(r, clr):
-    rbd_val = r.get('RBD', 'N/A'); nom_rbd_safe = html.escape(str(r.get('NOM_RBD', 'N/A')))
-    cod_depe_safe = html.escape(str(r.get('COD_DEPE', 'N/A'))); cod_depe2_safe = html.escape(str(r.get('COD_DEPE2', 'N/A')))
-    pie = r.get('CONVENIO_PIE', 0); pie_str = "Sí" if pie == 1 else "No"
-    pace = r.get('PACE', 0); pace_str = "Sí" if pace == 1 else "No"
-    ens_activas = [f"0{i}" for i in range(1, 7) if f'ENS_0{i}' in r and pd.notna(r[f'ENS_0{i}']) and str(r[f'ENS_0{i}']).strip() not in ['0', 'N/A', '', ' ']]
-    ens_str_safe = html.escape(", ".join(ens_activas) if ens_activas else "Ninguna (01-06)")
-    mat_total = r.get('MAT_TOTAL', 0); mat_total_safe = html.escape(str(mat_total))
-    popup_html = f"""<div style="width: 350px; font-family: {FONT_FAMILY}; border-radius: 5px; box-shadow: 0 1px 3px rgba(0,0,0,0.2); overflow: hidden; font-size: 14px;"><div style="background: {clr}; color: white; padding: 10px 15px; text-align: center;"><strong style="font-size: 16px; display: block; margin-bottom: 2px;">{nom_rbd_safe}</strong><span style="font-size: 13px;">RBD: {rbd_val}</span></div><div style="padding: 10px 15px; background: #f9f9f9; line-height: 1.5;"><p style="margin: 5px 0;"><strong>Dependencia (1/2):</strong> {cod_depe_safe} / {cod_depe2_safe}</p><p style="margin: 5px 0;"><strong>PIE:</strong> <span style="color: {'#E41A1C' if pie == 1 else '#555'}; font-weight:{'bold' if pie == 1 else 'normal'};">{pie_str}</span></p><p style="margin: 5px 0;"><strong>PACE:</strong> <span style="color: {'#377EB8' if pace == 1 else '#555'}; font-weight:{'bold' if pace == 1 else 'normal'};">{pace_str}</span></p><p style="margin: 5px 0;"><strong>Matrícula Total:</strong> {mat_total_safe}</p><hr style="border: none; border-top: 1px solid #eee; margin: 8px 0;"><p style="margin: 5px 0; color: #555;"><strong>Enseñanzas Activas (01-06):</strong><br>{ens_str_safe}</p></div></div>"""
-    return popup_html
-
-def get_table_download_link(df, filename="datos_filtrados.xlsx", link_text="Descargar Datos Filtrados (Excel)"):
-    output = io.BytesIO()
+def _a_entero(serie, dtype):
+    return pd.to_numeric(serie, errors='coerce').fillna(0).astype(dtype)
+
+def _compactar_codigo(serie, solo_texto=False):
+    # Códigos (dependencia, enseñanza): entero pequeño si todos los valores lo son; si no, categoría de textos.
+    if not solo_texto:
+        numerico = pd.to_numeric(serie, errors='coerce')
+        if numerico.notna().sum() == serie.notna().sum() and (numerico.dropna() % 1 == 0).all() and numerico.abs().max() < 2 ** 15:
+            return numerico.astype('Int16')
+    return serie.where(serie.isna(), serie.astype(str)).astype('category')
+
+def calcular_bits_ensenanzas(df):
+    # Bit i-1 encendido si ENS_0i tiene un código activo (no vacío, '0' ni 'N/A').
+    bits = np.zeros(len(df), dtype=np.int8)
+    for i, col_name in enumerate(COLS_ENS):
+        if col_name not in df.columns: continue
+        valores = df[col_name]
+        activa = valores.notna() & ~valores.astype(str).str.strip().isin(ENS_INACTIVOS) & ~(pd.to_numeric(valores, errors='coerce') == 0)
+        bits |= (activa.to_numpy() << i).astype(np.int8)
+    return bits
+
+def asignar_programa(df):
+    is_pie = (_columna_o_defecto(df, 'CONVENIO_PIE', 0) == 1).to_numpy(); is_pace = (_columna_o_defecto(df, 'PACE', 0) == 1).to_numpy()
+    programa = np.select([is_pie & is_pace, is_pie, is_pace], ['PIE y PACE', 'PIE', 'PACE'], 'Otros')
+    return pd.Categorical(programa, categories=PROGRAMAS)
+
+def _escapar_html_serie(serie):
+    # Equivalente vectorizado de html.escape (quote=True) para una Serie de textos.
+    return (serie.astype(str).str.replace('&', '&amp;', regex=False).str.replace('<', '&lt;', regex=False)
+            .str.replace('>', '&gt;', regex=False).str.replace('"', '&quot;', regex=False).str.replace("'", '&#x27;', regex=False))
+
+def _columna_o_defecto(df, col, defecto):
+    if col in df.columns: return df[col]
+    return pd.Series(defecto, index=df.index)
+
+def calcular_radios(mat_total):
+    mat = np.asarray(mat_total, dtype=float)
+    calculado = MARKER_BASE_SIZE_CALC + np.power(np.clip(mat, 0, None), MARKER_EXPONENT_CALC) / MARKER_DIVISOR_CALC
+    radios = np.clip(calculado, MARKER_MIN_RADIUS, MARKER_MAX_RADIUS)
+    return np.where(mat > 0, radios, MARKER_MIN_RADIUS)
+
+def calcular_colores(df):
+    if 'programa' not in df.columns: return pd.Series(DEFAULT_COLOR, index=df.index)
+    return df['programa'].astype(object).map(COLORS).fillna(DEFAULT_COLOR)
+
+# Texto "Enseñanzas Activas" para cada una de las 64 combinaciones de bits; los popups sólo indexan esta tabla.
+TEXTO_ENSENANZAS = np.array([", ".join(f"0{i + 1}" for i in range(6) if bits & (1 << i)) or "Ninguna (01-06)" for bits in range(64)], dtype=object)
+
+def calcular_ensenanzas_activas(df):
+    bits = df['ENS_ACTIVAS'].to_numpy() if 'ENS_ACTIVAS' in df.columns else calcular_bits_ensenanzas(df)
+    return pd.Series(TEXTO_ENSENANZAS[bits.astype(np.intp)], index=df.index)
+
+# Plantilla única del popup. Los campos {...} se rellenan en Python (popups embebidos) o en el navegador al
+# hacer clic (popups diferidos), siempre con valores ya escapados. Llaves simples y no {{...}}: folium pasa el
+# JsCode y el HTML por Jinja al renderizar la página, y Jinja vaciaría los campos dobles.
+POPUP_TEMPLATE = (
+    '<div style="width: 350px; font-family: ' + FONT_FAMILY + '; border-radius: 5px; box-shadow: 0 1px 3px rgba(0,0,0,0.2); overflow: hidden; font-size: 14px;"><div style="background: '
+    '{color}; color: white; padding: 10px 15px; text-align: center;"><strong style="font-size: 16px; display: block; margin-bottom: 2px;">'
+    '{nom}</strong><span style="font-size: 13px;">RBD: {rbd}</span></div><div style="padding: 10px 15px; background: #f9f9f9; line-height: 1.5;"><p style="margin: 5px 0;"><strong>Dependencia (1/2):</strong> '
+    '{cod_depe} / {cod_depe2}</p><p style="margin: 5px 0;"><strong>PIE:</strong> '
+    '{pie}</p><p style="margin: 5px 0;"><strong>PACE:</strong> '
+    '{pace}</p><p style="margin: 5px 0;"><strong>Matrícula Total:</strong> '
+    '{mat}</p><hr style="border: none; border-top: 1px solid #eee; margin: 8px 0;"><p style="margin: 5px 0; color: #555;"><strong>Enseñanzas Activas (01-06):</strong><br>'
+    '{ens}</p></div></div>'
+)
+POPUP_NO = '<span style="color: #555; font-weight:normal;">No</span>'
+POPUP_PIE = [POPUP_NO, '<span style="color: #E41A1C; font-weight:bold;">Sí</span>']
+POPUP_PACE = [POPUP_NO, '<span style="color: #377EB8; font-weight:bold;">Sí</span>']
+
+def _campos_popup(df):
+    es_pie = (_columna_o_defecto(df, 'CONVENIO_PIE', 0) == 1).to_numpy(); es_pace = (_columna_o_defecto(df, 'PACE', 0) == 1).to_numpy()
+    return {
+        'nom': _escapar_html_serie(_columna_o_defecto(df, 'NOM_RBD', 'N/A')),
+        'rbd': _columna_o_defecto(df, 'RBD', 'N/A').astype(str),
+        'cod_depe': _escapar_html_serie(_columna_o_defecto(df, 'COD_DEPE', 'N/A')),
+        'cod_depe2': _escapar_html_serie(_columna_o_defecto(df, 'COD_DEPE2', 'N/A')),
+        'flags': es_pie.astype(np.int8) | (es_pace.astype(np.int8) << 1),
+        'mat': _escapar_html_serie(_columna_o_defecto(df, 'MAT_TOTAL', 0)),
+        'ens_bits': df['ENS_ACTIVAS'].to_numpy() if 'ENS_ACTIVAS' in df.columns else calcular_bits_ensenanzas(df),
+    }
+
+def crear_popups_html(df, colores):
+    campos = _campos_popup(df)
+    valores = {
+        'color': colores.astype(str), 'nom': campos['nom'], 'rbd': campos['rbd'], 'cod_depe': campos['cod_depe'], 'cod_depe2': campos['cod_depe2'],
+        'pie': pd.Series(np.where(campos['flags'] & 1, POPUP_PIE[1], POPUP_PIE[0]), index=df.index),
+        'pace': pd.Series(np.where(campos['flags'] & 2, POPUP_PACE[1], POPUP_PACE[0]), index=df.index),
+        'mat': campos['mat'],
+        'ens': _escapar_html_serie(pd.Series(TEXTO_ENSENANZAS[campos['ens_bits'].astype(np.intp)], index=df.index)),
+    }
+    partes = re.split(r'\{(\w+)\}', POPUP_TEMPLATE)
+    popups = pd.Series(partes[0], index=df.index, dtype=object)
+    for campo, texto in zip(partes[1::2], partes[2::2]): popups = popups + valores[campo] + texto
+    return popups
+
+# Se ejecuta en el navegador por cada marcador: tooltip y popup se arman sólo cuando se muestran, desde los campos
+# compactos del feature y la plantilla compartida.
+JS_POPUP_DIFERIDO = """
+function(feature, layer) {
+    const p = feature.properties;
+    layer.setStyle({fillColor: %(paleta)s[p.c], radius: p.z});
+    layer.bindTooltip(() => p.n + ' (RBD: ' + p.r + ')');
+    layer.bindPopup(() => {
+        const campos = {color: %(paleta)s[p.c], nom: p.n, rbd: p.r, cod_depe: p.d1, cod_depe2: p.d2,
+                        pie: %(pie)s[p.f & 1], pace: %(pace)s[(p.f >> 1) & 1], mat: p.m, ens: %(ens)s[p.e]};
+        return %(template)s.replace(/\\{(\\w+)\\}/g, (_, campo) => campos[campo]);
+    }, {maxWidth: 400});
+}
+"""
+
+def construir_geojson_marcadores(df, popups_diferidos=True):
+    # Todas las columnas derivadas (radio, color, tooltip, popup) se calculan de una vez sobre el frame completo.
+    colores = calcular_colores(df)
+    radios = calcular_radios(_columna_o_defecto(df, 'MAT_TOTAL', 0))
+    if popups_diferidos:
+        # Sólo campos compactos: color como índice de PALETA_MARCADORES, radio con un decimal, coordenadas a ~1 m.
+        decimales = 5
+        campos = _campos_popup(df)
+        indices_color = colores.map({clr: i for i, clr in enumerate(PALETA_MARCADORES)}).fillna(len(PALETA_MARCADORES) - 1).astype(int)
+        propiedades = [
+            {"n": nom, "r": rbd, "d1": d1, "d2": d2, "f": flags, "m": mat, "e": ens, "c": clr, "z": radio}
+            for nom, rbd, d1, d2, flags, mat, ens, clr, radio in zip(
+                campos['nom'].tolist(), campos['rbd'].tolist(), campos['cod_depe'].tolist(), campos['cod_depe2'].tolist(), campos['flags'].tolist(),
+                campos['mat'].tolist(), campos['ens_bits'].tolist(), indices_color.tolist(), np.round(radios, 1).tolist())
+        ]
+    else:
+        decimales = 6
+        popups = crear_popups_html(df, colores)
+        tooltips = _escapar_html_serie(_columna_o_defecto(df, 'NOM_RBD', 'N/A')) + ' (RBD: ' + _columna_o_defecto(df, 'RBD', 'N/A').astype(str) + ')'
+        propiedades = [
+            {"tooltip": tooltip, "popup": popup, "style": {"fillColor": clr, "radius": radio}}
+            for tooltip, popup, clr, radio in zip(tooltips.tolist(), popups.tolist(), colores.tolist(), np.round(radios, 2).tolist())
+        ]
+    lats = np.round(df['LATITUD'].to_numpy(dtype=float), decimales).tolist(); lons = np.round(df['LONGITUD'].to_numpy(dtype=float), decimales).tolist()
+    features = [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]}, "properties": props}
+                for lat, lon, props in zip(lats, lons, propiedades)]
+    return {"type": "FeatureCollection", "features": features}
+
+def construir_capa_marcadores(df, nombre="Establecimientos", popups_diferidos=True):
+    # Una sola capa GeoJSON para todos los puntos; el estilo de cada punto viaja en properties.style.
+    marcador = folium.CircleMarker(radius=MARKER_MIN_RADIUS, color='#333333', weight=0.5, fill=True, fill_color=DEFAULT_COLOR, fill_opacity=0.7)
+    geojson = construir_geojson_marcadores(df, popups_diferidos=popups_diferidos)
+    if popups_diferidos:
+        js = JS_POPUP_DIFERIDO % {'paleta': json.dumps(PALETA_MARCADORES), 'pie': json.dumps(POPUP_PIE), 'pace': json.dumps(POPUP_PACE),
+                                  'ens': json.dumps([html.escape(t) for t in TEXTO_ENSENANZAS]), 'template': json.dumps(POPUP_TEMPLATE)}
+        return folium.GeoJson(geojson, name=nombre, marker=marcador, on_each_feature=JsCode(js))
+    return folium.GeoJson(
+        geojson, name=nombre, marker=marcador,
+        tooltip=folium.GeoJsonTooltip(fields=['tooltip'], labels=False, localize=False),
+        popup=folium.GeoJsonPopup(fields=['popup'], labels=False, localize=False, max_width=400)
+    )
+
+# --- Agrupamiento por zoom y recorte al viewport ---
+def _proyectar_mercator(lat, lon):
+    # Coordenadas Web Mercator normalizadas a [0, 1), las mismas que usa Leaflet para sus tiles.
+    lat = np.clip(np.asarray(lat, dtype=float), -85.0511, 85.0511); lon = np.asarray(lon, dtype=float)
+    x = (lon + 180.0) / 360.0
+    sin_lat = np.sin(np.radians(lat))
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)
+    return x, y
+
+def _desproyectar_mercator(x, y):
+    lon = np.asarray(x, dtype=float) * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(y, dtype=float)))))
+    return lat, lon
+
+def _celdas_por_lado(zoom):
+    return max(1, (256 * 2 ** int(zoom)) // CLUSTER_CELDA_PX)
+
+def construir_jerarquia_clusters(df):
+    """Precalcula, para cada zoom agrupable, la celda de la grilla a la que pertenece cada fila (posicional)."""
+    x, y = _proyectar_mercator(df['LATITUD'].to_numpy(), df['LONGITUD'].to_numpy())
+    jerarquia = {}
+    for zoom in range(CLUSTER_MIN_ZOOM, CLUSTER_MAX_ZOOM):
+        n = _celdas_por_lado(zoom)
+        cx = np.minimum((x * n).astype(np.int64), n - 1); cy = np.minimum((y * n).astype(np.int64), n - 1)
+        jerarquia[zoom] = cx * n + cy
+    return jerarquia
+
+def estimar_bounds(center, zoom, ancho_px=MAP_WIDTH_PX_ESTIMADO, alto_px=MAP_HEIGHT_PX):
+    x, y = _proyectar_mercator(center[0], center[1])
+    mundo_px = 256 * 2 ** float(zoom)
+    sur, oeste = _desproyectar_mercator(x - ancho_px / 2 / mundo_px, y + alto_px / 2 / mundo_px)
+    norte, este = _desproyectar_mercator(x + ancho_px / 2 / mundo_px, y - alto_px / 2 / mundo_px)
+    return {'_southWest': {'lat': float(sur), 'lng': float(oeste)}, '_northEast': {'lat': float(norte), 'lng': float(este)}}
+
+def expandir_bounds_a_tiles(bounds, zoom):
+    # Agranda los bounds media pantalla por lado y los ajusta a la grilla de tiles del zoom actual, así
+    # pequeños paneos (o bounds que difieren en decimales) no cambian el contenido enviado al navegador.
+    sw, ne = bounds['_southWest'], bounds['_northEast']
+    x0, y1 = _proyectar_mercator(sw['lat'], sw['lng']); x1, y0 = _proyectar_mercator(ne['lat'], ne['lng'])
+    mx, my = (x1 - x0) / 2, (y1 - y0) / 2
+    n_tiles = 2 ** int(zoom)
+    x0 = np.floor((x0 - mx) * n_tiles) / n_tiles; x1 = np.ceil((x1 + mx) * n_tiles) / n_tiles
+    y0 = np.floor((y0 - my) * n_tiles) / n_tiles; y1 = np.ceil((y1 + my) * n_tiles) / n_tiles
+    norte, oeste = _desproyectar_mercator(x0, y0); sur, este = _desproyectar_mercator(x1, y1)
+    return float(sur), float(oeste), float(norte), float(este)
+
+def seleccionar_en_viewport(df, bounds, zoom):
+    sur, oeste, norte, este = expandir_bounds_a_tiles(bounds, zoom)
+    lat = df['LATITUD'].to_numpy(); lon = df['LONGITUD'].to_numpy()
+    return df[(lat >= sur) & (lat <= norte) & (lon >= oeste) & (lon <= este)]
+
+def agrupar_clusters(df, jerarquia, zoom):
+    celdas = jerarquia[int(zoom)][df.index.to_numpy()]
+    mat = _columna_o_defecto(df, 'MAT_TOTAL', 0).to_numpy()
+    agrupado = pd.DataFrame({'celda': celdas, 'LATITUD': df['LATITUD'].to_numpy(), 'LONGITUD': df['LONGITUD'].to_numpy(), 'MAT_TOTAL': mat})
+    return agrupado.groupby('celda', sort=False).agg(n=('LATITUD', 'size'), LATITUD=('LATITUD', 'mean'), LONGITUD=('LONGITUD', 'mean'), MAT_TOTAL=('MAT_TOTAL', 'sum')).reset_index(drop=True)
+
+def preparar_vista_mapa(df, jerarquia, zoom, bounds, agrupamiento='clusters', densidad=None):
+    """Devuelve ('clusters' | 'densidad' | 'puntos', frame) con sólo lo visible en el viewport al zoom actual."""
+    zoom = int(round(zoom))
+    # Bajo CLUSTER_MIN_ZOOM se agrupa con la grilla más gruesa precalculada: el mapa no limita el zoom mínimo y sin
+    # esto se enviaría cada fila como marcador individual.
+    nivel = max(zoom, CLUSTER_MIN_ZOOM)
+    agrupable = agrupamiento != 'ninguno' and jerarquia is not None and zoom < CLUSTER_MAX_ZOOM and nivel in jerarquia
+    if agrupable and agrupamiento == 'densidad' and densidad is not None:
+        # Los agregados ya están por celda: el total visible decide el modo sin recorrer las filas.
+        celdas = densidad.celdas_en_viewport(nivel, bounds)
+        if celdas['n'].sum() > MAX_PUNTOS_INDIVIDUALES: return 'densidad', celdas
+        return 'puntos', seleccionar_en_viewport(df, bounds, zoom)
+    df_viewport = seleccionar_en_viewport(df, bounds, zoom)
+    if not agrupable or len(df_viewport) <= MAX_PUNTOS_INDIVIDUALES:
+        return 'puntos', df_viewport
+    return 'clusters', agrupar_clusters(df_viewport, jerarquia, nivel)
+
+def construir_capa_clusters(clusters, nombre="Clusters"):
+    n = clusters['n'].to_numpy()
+    radios = np.round(np.clip(8 + 4 * np.log10(n), 8, 30), 2)
+    tooltips = [f"{cnt:,} establecimientos · Matrícula total: {mat:,}".replace(',', '.') for cnt, mat in zip(n.tolist(), clusters['MAT_TOTAL'].astype(int).tolist())]
+    features = [
+        {"type": "Feature", "geometry": {"type": "Point", "coordinates": [round(lon, 6), round(lat, 6)]},
+         "properties": {"tooltip": tooltip, "style": {"radius": radio}}}
+        for lat, lon, tooltip, radio in zip(clusters['LATITUD'].tolist(), clusters['LONGITUD'].tolist(), tooltips, radios.tolist())
+    ]
+    return folium.GeoJson(
+        {"type": "FeatureCollection", "features": features}, name=nombre, zoom_on_click=True,
+        marker=folium.CircleMarker(radius=8, color='#ffffff', weight=2, fill=True, fill_color=CLUSTER_COLOR, fill_opacity=0.75),
+        tooltip=folium.GeoJsonTooltip(fields=['tooltip'], labels=False, localize=False)
+    )
+
+def clave_mapa():
+    # Cambia sólo al reiniciar el mapa: st_folium monta un componente nuevo y el navegador olvida vista y dibujos.
+    return f"map1_{st.session_state.get('mapa_version', 0)}"
+
+def reiniciar_mapa():
+    st.session_state.pop(clave_mapa(), None)
+    st.session_state.mapa_version = st.session_state.get('mapa_version', 0) + 1; st.session_state.capa_datos = None
+
+def sincronizar_vista_mapa(map_output):
+    # st_folium entrega 'center' como {'lat', 'lng'}, 'zoom' como número y 'bounds' con _southWest/_northEast.
+    if not map_output: return
+    new_center = map_output.get("center")
+    if isinstance(new_center, dict) and new_center.get('lat') is not None and new_center.get('lng') is not None:
+        new_center = [round(float(new_center['lat']), 6), round(float(new_center['lng']), 6)]
+        if new_center != st.session_state.map_center: st.session_state.map_center = new_center
+    elif new_center: print(f"WARN: center recibido de st_folium no es válido: {new_center}")
+    new_zoom = map_output.get("zoom")
+    if isinstance(new_zoom, (int, float)) and not isinstance(new_zoom, bool):  # 0 es un zoom válido
+        if new_zoom != st.session_state.map_zoom: st.session_state.map_zoom = new_zoom
+    elif new_zoom: print(f"WARN: zoom recibido de st_folium no es válido: {new_zoom}")
+    new_bounds = map_output.get("bounds")
+    if isinstance(new_bounds, dict) and all((new_bounds.get(k) or {}).get('lat') is not None for k in ('_southWest', '_northEast')):
+        st.session_state.map_bounds = new_bounds
+    # Tras un remount el navegador olvida los dibujos y envía all_drawings vacío: sólo se reemplazan con dibujos nuevos.
+    new_drawings = map_output.get("all_drawings")
+    if isinstance(new_drawings, list) and new_drawings and new_drawings != st.session_state.dibujos:
+        print(f"\n--- CAMBIO DETECTADO: {len(new_drawings)} dibujo(s) en el mapa ---")
+        st.session_state.dibujos = new_drawings
+
+# --- Capas de densidad: agregados por celda de la grilla de clusters ---
+class GrillaDensidad:
+    """Celdas ocupadas por zoom y código denso de celda por fila, precalculados una vez por archivo; agregar una
+    selección es un np.bincount por columna, sin groupby."""
+
+    COLUMNAS = ['n', 'MAT_TOTAL'] + PROGRAMAS_DENSIDAD
+
+    def __init__(self, df, jerarquia):
+        self.n_filas = len(df)
+        self.celdas = {}   # zoom -> ids de celda ocupados (cx * n + cy), ordenados
+        self.codigos = {}  # zoom -> posición de la celda de cada fila dentro de self.celdas[zoom]
+        for zoom, ids in (jerarquia or {}).items():
+            celdas, codigos = np.unique(ids, return_inverse=True)
+            self.celdas[zoom] = celdas; self.codigos[zoom] = codigos.astype(np.int32)
+        programa = df['programa'].astype(str).to_numpy() if 'programa' in df.columns else np.full(len(df), 'N/A')
+        self.pesos = [_columna_o_defecto(df, 'MAT_TOTAL', 0).to_numpy(dtype=np.float64)] + [(programa == p).astype(np.float64) for p in PROGRAMAS_DENSIDAD]
+
+    def agregar(self, zoom, filas):
+        """Tabla (celdas x COLUMNAS) con los totales de las filas dadas (posiciones) al zoom indicado."""
+        codigos = self.codigos[zoom][filas]; k = len(self.celdas[zoom])
+        columnas = [np.bincount(codigos, minlength=k).astype(np.float64)] + [np.bincount(codigos, weights=w[filas], minlength=k) for w in self.pesos]
+        return np.column_stack(columnas)
+
+    def rectangulos(self, zoom, posiciones):
+        # Esquinas (sur, oeste, norte, este) de las celdas: inversa de la grilla de construir_jerarquia_clusters.
+        n = _celdas_por_lado(zoom); ids = self.celdas[zoom][posiciones]
+        cx, cy = ids // n, ids % n
+        norte, oeste = _desproyectar_mercator(cx / n, cy / n); sur, este = _desproyectar_mercator((cx + 1) / n, (cy + 1) / n)
+        return sur, oeste, norte, este
+
+class DensidadSeleccion:
+    """Agregados de la selección de una sesión por zoom. Al cambiar los filtros se suman las filas que entran y se
+    restan las que salen, en vez de recalcular desde cero."""
+
+    def __init__(self, grilla):
+        self.grilla = grilla
+        self.mascara = np.zeros(grilla.n_filas, dtype=bool)
+        self.agregados = {}  # zoom -> tabla de GrillaDensidad.agregar, sólo para los zooms ya vistos
+
+    def actualizar(self, mascara):
+        if np.array_equal(mascara, self.mascara): return
+        entran = np.flatnonzero(mascara & ~self.mascara); salen = np.flatnonzero(self.mascara & ~mascara)
+        if len(entran) + len(salen) < np.count_nonzero(mascara):
+            for zoom, tabla in self.agregados.items():
+                tabla += self.grilla.agregar(zoom, entran); tabla -= self.grilla.agregar(zoom, salen)
+        else:
+            self.agregados = {}  # Cambio mayor que la selección: sale más barato recalcular al pedir cada zoom
+        self.mascara = mascara.copy()
+
+    def en_zoom(self, zoom):
+        if zoom not in self.agregados: self.agregados[zoom] = self.grilla.agregar(zoom, np.flatnonzero(self.mascara))
+        return self.agregados[zoom]
+
+    def celdas_en_viewport(self, zoom, bounds):
+        """Frame con las celdas no vacías que tocan el viewport (expandido a tiles) y sus totales."""
+        tabla = self.en_zoom(zoom)
+        sur_v, oeste_v, norte_v, este_v = expandir_bounds_a_tiles(bounds, zoom)
+        ocupadas = np.flatnonzero(tabla[:, 0] > 0)
+        sur, oeste, norte, este = self.grilla.rectangulos(zoom, ocupadas)
+        visibles = (norte >= sur_v) & (sur <= norte_v) & (este >= oeste_v) & (oeste <= este_v)
+        celdas = pd.DataFrame(tabla[ocupadas[visibles]], columns=GrillaDensidad.COLUMNAS).astype(np.int64)
+        celdas['sur'], celdas['oeste'], celdas['norte'], celdas['este'] = sur[visibles], oeste[visibles], norte[visibles], este[visibles]
+        return celdas
+
+def construir_capa_densidad(celdas, nombre="Densidad"):
+    n = celdas['n'].to_numpy()
+    # Color por cuantil logarítmico dentro de lo visible, así siempre se distingue el rango en pantalla.
+    escala = np.log1p(n) / max(np.log1p(n.max()), 1e-9)
+    colores = np.array(DENSIDAD_COLORES)[np.minimum((escala * len(DENSIDAD_COLORES)).astype(int), len(DENSIDAD_COLORES) - 1)]
+    tooltips = [f"<b>{cnt:,} establecimientos</b><br>Matrícula total: {mat:,}<br>PIE: {pie:,} · PACE: {pace:,} · PIE y PACE: {ambos:,}".replace(',', '.')
+                for cnt, mat, pie, pace, ambos in zip(n.tolist(), *(celdas[c].tolist() for c in ['MAT_TOTAL'] + PROGRAMAS_DENSIDAD))]
+    features = [
+        {"type": "Feature", "geometry": {"type": "Polygon", "coordinates": [[[o, s], [e, s], [e, nn], [o, nn], [o, s]]]},
+         "properties": {"tooltip": tooltip, "style": {"fillColor": clr, "color": '#ffffff', "weight": 0.5, "fillOpacity": 0.6}}}
+        for s, o, nn, e, tooltip, clr in zip(*(np.round(celdas[c].to_numpy(), 6).tolist() for c in ['sur', 'oeste', 'norte', 'este']), tooltips, colores.tolist())
+    ]
+    return folium.GeoJson(
+        {"type": "FeatureCollection", "features": features}, name=nombre, zoom_on_click=True,
+        tooltip=folium.GeoJsonTooltip(fields=['tooltip'], labels=False, localize=False)
+    )
+
+# --- Índice espacial sobre LATITUD/LONGITUD ---
+def distancia_haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def _puntos_en_anillo(lat, lon, anillo):
+    # Ray casting vectorizado sobre los puntos; el anillo viene en orden GeoJSON [lon, lat].
+    anillo = np.asarray(anillo, dtype=float)
+    xs, ys = anillo[:, 0], anillo[:, 1]
+    dentro = np.zeros(len(lat), dtype=bool)
+    for x1, y1, x2, y2 in zip(xs, ys, np.roll(xs, -1), np.roll(ys, -1)):
+        if y1 == y2: continue
+        cruza = (y1 > lat) != (y2 > lat)
+        dentro ^= cruza & (lon < (x2 - x1) * (lat - y1) / (y2 - y1) + x1)
+    return dentro
+
+class IndiceEspacial:
+    """Grilla regular sobre las coordenadas limpias. Las consultas devuelven posiciones de fila ordenadas."""
+
+    def __init__(self, lat, lon, celda_grados=INDICE_CELDA_GRADOS):
+        lat = np.asarray(lat, dtype=np.float64); lon = np.asarray(lon, dtype=np.float64)
+        self.celda = celda_grados
+        self.lat0 = float(lat.min()) if len(lat) else 0.0; self.lon0 = float(lon.min()) if len(lon) else 0.0
+        cy = ((lat - self.lat0) // celda_grados).astype(np.int64); cx = ((lon - self.lon0) // celda_grados).astype(np.int64)
+        self.ny = int(cy.max()) + 1 if len(cy) else 1; self.nx = int(cx.max()) + 1 if len(cx) else 1
+        claves = cx * self.ny + cy
+        # Las filas se guardan ordenadas por celda: cada columna de la grilla es un tramo contiguo.
+        self.orden = np.argsort(claves, kind='stable')
+        self.claves = claves[self.orden]
+        self.lat = lat[self.orden]; self.lon = lon[self.orden]
+
+    def __len__(self):
+        return len(self.orden)
+
+    def _candidatos(self, sur, oeste, norte, este):
+        cx0 = max(int((oeste - self.lon0) // self.celda), 0); cx1 = min(int((este - self.lon0) // self.celda), self.nx - 1)
+        cy0 = max(int((sur - self.lat0) // self.celda), 0); cy1 = min(int((norte - self.lat0) // self.celda), self.ny - 1)
+        if cx0 > cx1 or cy0 > cy1: return np.empty(0, dtype=np.int64)
+        columnas = np.arange(cx0, cx1 + 1, dtype=np.int64) * self.ny
+        inicios = np.searchsorted(self.claves, columnas + cy0, side='left')
+        fines = np.searchsorted(self.claves, columnas + cy1, side='right')
+        tramos = [np.arange(a, b) for a, b in zip(inicios.tolist(), fines.tolist()) if b > a]
+        return np.concatenate(tramos) if tramos else np.empty(0, dtype=np.int64)
+
+    def en_rectangulo(self, sur, oeste, norte, este):
+        cand = self._candidatos(sur, oeste, norte, este)
+        lat = self.lat[cand]; lon = self.lon[cand]
+        return np.sort(self.orden[cand[(lat >= sur) & (lat <= norte) & (lon >= oeste) & (lon <= este)]])
+
+    def en_circulo(self, lat_c, lon_c, radio_km):
+        d_lat = np.degrees(radio_km / RADIO_TIERRA_KM)
+        d_lon = d_lat / max(np.cos(np.radians(lat_c)), 1e-6)
+        cand = self._candidatos(lat_c - d_lat, lon_c - d_lon, lat_c + d_lat, lon_c + d_lon)
+        dist = distancia_haversine_km(self.lat[cand], self.lon[cand], lat_c, lon_c)
+        return np.sort(self.orden[cand[dist <= radio_km]])
+
+    def en_poligono(self, anillos):
+        """anillos: coordenadas de un Polygon GeoJSON ([exterior, hueco1, ...], cada uno en [lon, lat])."""
+        exterior = np.asarray(anillos[0], dtype=float)
+        cand = self._candidatos(exterior[:, 1].min(), exterior[:, 0].min(), exterior[:, 1].max(), exterior[:, 0].max())
+        lat = self.lat[cand]; lon = self.lon[cand]
+        dentro = _puntos_en_anillo(lat, lon, exterior)
+        for hueco in anillos[1:]: dentro &= ~_puntos_en_anillo(lat, lon, hueco)
+        return np.sort(self.orden[cand[dentro]])
+
+    def en_dibujos(self, features):
+        """Unión de las posiciones dentro de los dibujos de Leaflet.Draw (Polygon/MultiPolygon o Point con radio en metros)."""
+        resultados = []
+        for feature in features or []:
+            geom = (feature or {}).get('geometry') or {}; tipo = geom.get('type'); coords = geom.get('coordinates')
+            if tipo == 'Polygon': resultados.append(self.en_poligono(coords))
+            elif tipo == 'MultiPolygon': resultados.extend(self.en_poligono(p) for p in coords)
+            elif tipo == 'Point' and (feature.get('properties') or {}).get('radius'):
+                resultados.append(self.en_circulo(coords[1], coords[0], feature['properties']['radius'] / 1000.0))
+        if not resultados: return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(resultados))
+
+def construir_capa_dibujos(features, nombre="Área de filtro"):
+    capa = folium.FeatureGroup(name=nombre)
+    for feature in features or []:
+        geom = feature.get('geometry') or {}
+        if geom.get('type') == 'Point' and (feature.get('properties') or {}).get('radius'):
+            lon, lat = geom['coordinates']
+            folium.Circle(location=[lat, lon], radius=feature['properties']['radius'], color=DIBUJO_COLOR, weight=2, fill=True, fill_opacity=0.05).add_to(capa)
+        elif geom.get('type') in ('Polygon', 'MultiPolygon'):
+            folium.GeoJson(feature, style_function=lambda _: {'color': DIBUJO_COLOR, 'weight': 2, 'fillOpacity': 0.05}).add_to(capa)
+    return capa
+
+# --- Motor de filtros del sidebar (índices precalculados por archivo) ---
+def _ordenar_dependencias(deps_list):
+    try: return sorted(deps_list, key=lambda x: int(x) if x.isdigit() else float('inf'))
+    except ValueError: return sorted(deps_list)
+
+class MotorFiltros:
+    """Índices de los filtros del sidebar, construidos una vez por archivo.
+
+    'programa' y 'COD_DEPE2' se guardan como códigos categóricos con una máscara booleana precalculada por valor,
+    y MAT_TOTAL ordenado para resolver rangos con búsqueda binaria. seleccionar() devuelve una máscara sobre las
+    posiciones de fila del frame original, sin copiarlo.
+    """
+
+    def __init__(self, df):
+        self.n_filas = len(df)
+        self.programas = self._indexar_categoria(df['programa'].astype(str)) if 'programa' in df.columns else {}
+        self.dependencias = {}
+        if 'COD_DEPE2' in df.columns:
+            dep = df['COD_DEPE2']
+            self.dependencias = self._indexar_categoria(dep.where(dep.isna(), dep.astype(str)))
+        self.mat_orden = None; self.mat_ordenada = None
+        if 'MAT_TOTAL' in df.columns:
+            mat = df['MAT_TOTAL'].to_numpy()
+            self.mat_orden = np.argsort(mat, kind='stable'); self.mat_ordenada = mat[self.mat_orden]
+
+    @staticmethod
+    def _indexar_categoria(serie):
+        categorias = pd.Categorical(serie)
+        codigos = categorias.codes
+        return {str(valor): codigos == i for i, valor in enumerate(categorias.categories)}
+
+    @property
+    def opciones_programa(self):
+        return sorted(self.programas) if self.programas else ['N/A']
+
+    @property
+    def opciones_dependencia(self):
+        return _ordenar_dependencias(list(self.dependencias))
+
+    @property
+    def rango_matricula(self):
+        if self.mat_ordenada is None or not len(self.mat_ordenada): return None
+        return int(self.mat_ordenada[0]), int(self.mat_ordenada[-1])
+
+    def mascara_matricula(self, minimo, maximo):
+        inicio = np.searchsorted(self.mat_ordenada, minimo, side='left'); fin = np.searchsorted(self.mat_ordenada, maximo, side='right')
+        mascara = np.zeros(self.n_filas, dtype=bool); mascara[self.mat_orden[inicio:fin]] = True
+        return mascara
+
+    def seleccionar(self, programas=None, dependencia="Todos", rango_matricula=None):
+        mascara = np.ones(self.n_filas, dtype=bool)
+        if programas and self.programas:
+            en_programas = np.zeros(self.n_filas, dtype=bool)
+            for programa in programas:
+                if programa in self.programas: en_programas |= self.programas[programa]
+            mascara &= en_programas
+        if dependencia != "Todos" and self.dependencias:
+            mascara &= self.dependencias.get(dependencia, np.zeros(self.n_filas, dtype=bool))
+        if rango_matricula and self.mat_ordenada is not None:
+            mascara &= self.mascara_matricula(rango_matricula[0], rango_matricula[1])
+        return mascara
+
+# --- Registro compartido de datasets (una copia por contenido para todas las sesiones del proceso) ---
+class DatasetCompartido:
+    """Frame procesado y sus estructuras derivadas. Lo comparten todas las sesiones que cargan el mismo archivo,
+    así que nadie lo modifica: los filtros trabajan con máscaras y cada sesión guarda sólo su selección."""
+
+    def __init__(self, digest, df):
+        self.digest = digest
+        self.df = df
+        self.jerarquia_clusters = construir_jerarquia_clusters(df)
+        self.indice_espacial = IndiceEspacial(df['LATITUD'], df['LONGITUD'])
+        self.motor_filtros = MotorFiltros(df)
+        self.grilla_densidad = GrillaDensidad(df, self.jerarquia_clusters)
+        # El frame no cambia: se mide una vez y no en cada rerun del panel de depuración (deep=True recorre los str).
+        self.memoria_mb = df.memory_usage(deep=True).sum() / (1024 * 1024)
+
+@st.cache_resource(max_entries=REGISTRO_MAX_DATASETS, show_spinner=False)
+def obtener_dataset(_uploaded_file_obj, file_digest):
+    # cache_resource no copia el resultado (a diferencia de cache_data): todas las sesiones reciben el mismo objeto.
+    # La memoria crece con los archivos distintos, no con las sesiones.
+    df = load_and_process_data(_uploaded_file_obj, file_digest)
+    if df is None or df.empty: return None
+    with medir_etapa('indices', filas=len(df)):
+        dataset = DatasetCompartido(file_digest, df)
+    print(f"FN CACHE: dataset {file_digest[:12]} registrado para el proceso ({dataset.memoria_mb:.1f} MB).")
+    return dataset
+
+# --- Perfilado por etapas (tiempo, filas y tamaño de payload de cada rerun) ---
+class Perfilador:
+    """Registro acotado de mediciones por etapa; cada medición queda asociada al número de rerun."""
+
+    COLUMNAS = ['rerun', 'marca', 'etapa', 'ms', 'filas', 'bytes']
+
+    def __init__(self, max_registros=PERFIL_MAX_REGISTROS):
+        self.registros = collections.deque(maxlen=max_registros)
+        self.rerun = 0
+        self.inicio_rerun = time.perf_counter()
+        self.abierto = False  # True mientras corre el script completo (un fragmento solo abre su propia medición)
+
+    def nuevo_rerun(self):
+        self.rerun += 1; self.inicio_rerun = time.perf_counter(); self.abierto = True
+
+    def registrar(self, etapa, ms, filas=None, bytes=None):
+        self.registros.append({'rerun': self.rerun, 'marca': datetime.datetime.now().isoformat(timespec='milliseconds'), 'etapa': etapa,
+                               'ms': round(ms, 2), 'filas': filas, 'bytes': bytes})
+
+    @contextlib.contextmanager
+    def etapa(self, nombre, filas=None):
+        # El bloque puede completar filas/bytes en el dict entregado (p.ej. filas resultantes tras filtrar).
+        medicion = {'filas': filas, 'bytes': None}; inicio = time.perf_counter()
+        try:
+            yield medicion
+        finally:
+            self.registrar(nombre, (time.perf_counter() - inicio) * 1000, **medicion)
+
+    def cerrar_rerun(self, etapa='rerun_total'):
+        self.registrar(etapa, (time.perf_counter() - self.inicio_rerun) * 1000); self.abierto = False
+
+    def como_dataframe(self):
+        return pd.DataFrame(list(self.registros), columns=self.COLUMNAS)
+
+    def resumen(self):
+        # Estadísticas por etapa sobre todo el historial, para detectar regresiones entre reruns.
+        df = self.como_dataframe()
+        if df.empty: return df
+        resumen = df.groupby('etapa', sort=False)['ms'].agg(n='count', media='mean', p95=lambda s: s.quantile(0.95), max='max').round(1)
+        return resumen.reindex([e for e in PERFIL_ETAPAS if e in resumen.index] + [e for e in resumen.index if e not in PERFIL_ETAPAS])
+
+    def exportar(self, formato):
+        if formato == 'json': return json.dumps(list(self.registros), ensure_ascii=False, indent=1)
+        return self.como_dataframe().to_csv(index=False)
+
+def mostrar_panel_perfilado(contenedor, perfilador):
+    # Se llena al final del rerun, cuando ya están todas las etapas medidas.
+    with contenedor:
+        df_perfil = perfilador.como_dataframe()
+        st.write(f"**Rerun #{perfilador.rerun}:**")
+        st.dataframe(df_perfil[df_perfil['rerun'] == perfilador.rerun][['etapa', 'ms', 'filas', 'bytes']], hide_index=True)
+        st.write(f"**Historial ({len(df_perfil)} mediciones, ms por etapa):**")
+        st.dataframe(perfilador.resumen())
+        col_json, col_csv = st.columns(2)
+        col_json.download_button("⬇️ JSON", data=lambda: perfilador.exportar('json'), file_name="perfil_mapa.json", mime='application/json', on_click='ignore', key='descarga_perfil_json')
+        col_csv.download_button("⬇️ CSV", data=lambda: perfilador.exportar('csv'), file_name="perfil_mapa.csv", mime='text/csv', on_click='ignore', key='descarga_perfil_csv')
+
+def registrar_etapa(nombre, inicio, filas=None, bytes=None):
+    # Variante para tramos que no se prestan a un bloque with; inicio es un time.perf_counter().
+    perfilador = st.session_state.get('perfilador')
+    if perfilador is not None: perfilador.registrar(nombre, (time.perf_counter() - inicio) * 1000, filas=filas, bytes=bytes)
+
+def medir_etapa(nombre, filas=None):
+    # Sin perfilador en la sesión (p.ej. importado desde benchmarks) la medición no hace nada.
+    perfilador = st.session_state.get('perfilador')
+    return perfilador.etapa(nombre, filas) if perfilador is not None else contextlib.nullcontext({'filas': filas, 'bytes': None})
+
+# --- Exportación de los datos filtrados (generada sólo al hacer clic, en caché por estado de filtros) ---
+def clave_estado_filtros(digest, programas, dependencia, rango_matricula, dibujos, radio_km):
+    # Resume todo lo que determina la selección; dos reruns con los mismos filtros comparten la exportación.
+    estado = [digest, sorted(programas or []), dependencia, list(rango_matricula) if rango_matricula else None, dibujos or [], float(radio_km or 0)]
+    return hashlib.sha256(json.dumps(estado, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def _preparar_exportacion(df):
+    df_export = df.drop(columns=[c for c in COLS_INTERNAS_EXPORTACION if c in df.columns])
+    for col in df_export.select_dtypes(include=['datetime64[ns]', 'timedelta64[ns]']).columns: df_export[col] = df_export[col].astype(str)
+    # Las coordenadas se guardan en float32 (~7 cifras significativas): a 5 decimales (~1 m) se exportan sin el ruido
+    # de la conversión a float64; a 6 decimales ese ruido sigue visible (-70.6 -> -70.599998).
+    for col in df_export.select_dtypes(include=['float32']).columns: df_export[col] = df_export[col].astype(float).round(5)
+    return df_export
+
+def _valores_python(df):
+    # Columnas como listas de tipos nativos (int/float/str/None) para openpyxl y json.
+    columnas = []
+    for col in df.columns:
+        serie = df[col]
+        if isinstance(serie.dtype, pd.CategoricalDtype) or serie.dtype == object: serie = serie.astype(object)
+        columnas.append([None if pd.isna(v) else v for v in serie.tolist()])
+    return columnas
+
+def _exportar_xlsx(df):
+    salida = io.BytesIO()
+    if len(df) <= EXPORT_XLSX_FILAS_WRITE_ONLY:
+        with pd.ExcelWriter(salida, engine='openpyxl') as writer: df.to_excel(writer, index=False, sheet_name='Sheet1')
+        return salida.getvalue()
+    # Selecciones grandes: modo write-only de openpyxl, fila a fila y sin mantener el libro en memoria.
+    import openpyxl
+    wb = openpyxl.Workbook(write_only=True); ws = wb.create_sheet('Sheet1')
+    ws.append([str(c) for c in df.columns])
+    for fila in zip(*_valores_python(df)): ws.append(fila)
+    wb.save(salida)
+    return salida.getvalue()
+
+def _exportar_geojson(df):
+    otras = [c for c in df.columns if c not in ('LATITUD', 'LONGITUD')]
+    lats = df['LATITUD'].astype(float).tolist(); lons = df['LONGITUD'].astype(float).tolist()
+    propiedades = _valores_python(df[otras])
+    features = [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [lon, lat]}, "properties": dict(zip(otras, valores))}
+                for lat, lon, *valores in zip(lats, lons, *propiedades)]
+    return json.dumps({"type": "FeatureCollection", "features": features}, ensure_ascii=False).encode('utf-8')
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def exportar_datos(_df, clave_filtros, formato):
+    # _df no se hashea: la clave de filtros ya identifica la selección.
+    print(f"--- Generando exportación {formato} ({len(_df)} filas, clave {clave_filtros[:12]}) ---")
     try:
-        with pd.ExcelWriter(output, engine='openpyxl') as writer:
-            df_download = df.copy();
-            for col in df_download.select_dtypes(include=['datetime64[ns]', 'timedelta64[ns]']).columns: df_download[col] = df_download[col].astype(str)
-            df_download.to_excel(writer, index=False, sheet_name='Sheet1')
-        excel_data = output.getvalue(); b64 = base64.b64encode(excel_data).decode()
-        safe_filename = html.escape(filename); safe_link_text = html.escape(link_text)
-        href = f'<a href="data:application/vnd.openxmlformats-officedocument.spreadsheetml.sheet;base64,{b64}" download="{safe_filename}">{safe_link_text}</a>'
-        return href
+        df_export = _preparar_exportacion(_df)
+        if formato == 'xlsx': return _exportar_xlsx(df_export)
+        if formato == 'csv': return df_export.to_csv(index=False).encode('utf-8-sig')
+        if formato == 'parquet':
+            salida = io.BytesIO(); df_export.to_parquet(salida, index=False); return salida.getvalue()
+        if formato == 'geojson': return _exportar_geojson(df_export)
+        raise ValueError(f"Formato de exportación no soportado: {formato}")
     except Exception as e:
-        st.error(f"Error al generar Excel para descarga: {e}"); print(f"ERROR generating download link: {e}\n{traceback.format_exc()}"); return "Error generando enlace."
+        print(f"ERROR generando exportación {formato}: {e}\n{traceback.format_exc()}"); raise
+
+# --- Mapa: base fija y capas que se reconstruyen sólo cuando cambian sus entradas ---
+def construir_mapa_base():
+    # Siempre idéntico entre reruns: st_folium conserva el mismo componente y sólo actualiza capas y vista.
+    m = folium.Map(location=[DEFAULT_LAT, DEFAULT_LON], zoom_start=DEFAULT_ZOOM, tiles='OpenStreetMap', control_scale=True)
+    folium.Marker(
+        location=[COLEGIO_LAT, COLEGIO_LON],
+        tooltip=html.escape(COLEGIO_NOMBRE),
+        popup=f"<b>{html.escape(COLEGIO_NOMBRE)}</b>",
+        icon=folium.Icon(color='darkblue', icon_color='white', icon='school', prefix='fa')
+    ).add_to(m)
+    Draw(export=False, filename='dibujo.geojson', position='topleft', draw_options={'polyline': False, 'polygon': {'showArea': True, 'metric': True, 'feet': False}, 'circle': {'showRadius': True, 'metric': True, 'feet': False}, 'rectangle': {'showArea': True, 'metric': True, 'feet': False}, 'marker': False, 'circlemarker': False}, edit_options={'edit': False, 'remove': False }).add_to(m)
+    return m
+
+def obtener_capa_datos(df_final_display, clave_filtros, agrupamiento, zoom, bounds):
+    # La capa se reutiliza mientras no cambien los filtros, el agrupamiento, el nivel de zoom ni el bloque de tiles
+    # visible (expandir_bounds_a_tiles); un paneo dentro de ese bloque no reconstruye marcadores.
+    nivel = int(round(zoom))
+    clave = (clave_filtros, agrupamiento, nivel, expandir_bounds_a_tiles(bounds, nivel))
+    capa = st.session_state.get('capa_datos')
+    if capa is not None and capa['clave'] == clave: return capa
+    with medir_etapa('marcadores') as medicion:
+        modo_vista, df_vista = preparar_vista_mapa(df_final_display, st.session_state.get('jerarquia_clusters'), zoom, bounds,
+                                                   agrupamiento=agrupamiento, densidad=st.session_state.get('densidad'))
+        grupo = folium.FeatureGroup(name="Establecimientos")
+        if not df_vista.empty:
+            try:
+                if modo_vista == 'clusters': construir_capa_clusters(df_vista).add_to(grupo)
+                elif modo_vista == 'densidad': construir_capa_densidad(df_vista).add_to(grupo)
+                else: construir_capa_marcadores(df_vista).add_to(grupo)
+            except Exception as e_marker:
+                st.error(f"Error al construir la capa de marcadores: {e_marker}")
+                print(f"ERROR al construir capa de marcadores ({modo_vista}): {e_marker}\n{traceback.format_exc()}")
+        medicion['filas'] = len(df_vista)
+    capa = st.session_state.capa_datos = {'clave': clave, 'grupo': grupo, 'modo': modo_vista, 'n_vista': len(df_vista)}
+    return capa
+
+def construir_capa_filtro_espacial():
+    grupo = folium.FeatureGroup(name="Filtro espacial")
+    if st.session_state.dibujos: construir_capa_dibujos(st.session_state.dibujos).add_to(grupo)
+    if st.session_state.radio_colegio_km > 0:
+        folium.Circle(location=[COLEGIO_LAT, COLEGIO_LON], radius=st.session_state.radio_colegio_km * 1000, color=DIBUJO_COLOR, weight=2, dash_array='6', fill=False).add_to(grupo)
+    return grupo
+
+@st.fragment
+def mostrar_mapa(df_final_display, clave_filtros, agrupamiento, perfilado_activo):
+    # Un paneo o zoom sólo vuelve a ejecutar este fragmento; sidebar, filtros y tabla no se recalculan.
+    perfilador = st.session_state.perfilador
+    solo_fragmento = not perfilador.abierto
+    if solo_fragmento: perfilador.nuevo_rerun()
+    dibujos_previos = st.session_state.dibujos
+    sincronizar_vista_mapa(st.session_state.get(clave_mapa()))
+    if st.session_state.dibujos is not dibujos_previos:
+        # Un dibujo nuevo cambia la selección: filtros, métricas y tabla necesitan el script completo.
+        st.rerun()
+
+    map_zoom = st.session_state.get('map_zoom', DEFAULT_ZOOM)
+    map_bounds = st.session_state.get('map_bounds') or estimar_bounds(st.session_state.get('map_center', [DEFAULT_LAT, DEFAULT_LON]), map_zoom)
+    capa = obtener_capa_datos(df_final_display, clave_filtros, agrupamiento, map_zoom, map_bounds)
+    if capa['modo'] == 'clusters':
+        st.info(f"✨ {len(df_final_display)} registros según filtros de sidebar. Zoom {int(round(map_zoom))}: {capa['n_vista']} grupos en pantalla (acerca el mapa o haz clic en un grupo para ver colegios individuales).")
+    elif capa['modo'] == 'densidad':
+        st.info(f"✨ {len(df_final_display)} registros según filtros de sidebar. Zoom {int(round(map_zoom))}: {capa['n_vista']} celdas de densidad en pantalla (acerca el mapa o haz clic en una celda para ver colegios individuales).")
+    else:
+        st.info(f"✨ Mostrando {len(df_final_display)} registros según filtros de sidebar ({capa['n_vista']} en pantalla). Marcadores individuales (sin agrupar).")
+
+    m = construir_mapa_base()
+    grupos = [capa['grupo'], construir_capa_filtro_espacial()]
+    print("Renderizando mapa con st_folium...")
+    if perfilado_activo:
+        with medir_etapa('serializacion', filas=capa['n_vista']) as medicion:
+            m_medicion = construir_mapa_base()
+            for grupo in grupos: grupo.add_to(m_medicion)
+            medicion['bytes'] = len(m_medicion.get_root().render().encode('utf-8'))
+    with medir_etapa('render', filas=capa['n_vista']):
+        # center/zoom mueven la vista sin volver a montar el mapa; las capas viajan aparte en feature_group_to_add.
+        map_output = st_folium(m, key=clave_mapa(), width='100%', height=MAP_HEIGHT_PX, center=st.session_state.get('map_center'), zoom=map_zoom,
+                               feature_group_to_add=grupos, returned_objects=["center", "zoom", "bounds", "all_drawings"])
+    print("Mapa renderizado.")
+
+    if map_output:
+        # Sin interacción, st_folium devuelve valores por defecto; la vista real llega en st.session_state[clave_mapa()]
+        # y se sincroniza al inicio del siguiente rerun (completo o del fragmento).
+        print("\n--- ESTADO DESPUÉS DE INTERACCIÓN MAPA ---")
+        print(f"Centro Actual en State: {st.session_state.get('map_center')}")
+        print(f"Zoom Actual en State: {st.session_state.get('map_zoom')}")
+        print("--- FIN ESTADO DESPUÉS DE INTERACCIÓN ---\n")
+    if solo_fragmento: perfilador.cerrar_rerun('fragmento_mapa')
+
+@st.fragment
+def mostrar_tabla(df_final_display, clave_filtros, n_filtrados_widgets):
+    # Cambiar el formato de descarga sólo vuelve a ejecutar este fragmento.
+    st.header("4. Datos Filtrados para Visualización")
+    st.metric("Registros Mostrados en Mapa", len(df_final_display))
+    if not df_final_display.empty:
+        cols_prio = ['RBD', 'NOM_RBD', 'programa', 'MAT_TOTAL', 'COD_DEPE', 'COD_DEPE2']; cols_geo = ['LATITUD', 'LONGITUD']; cols_prog_details = ['CONVENIO_PIE', 'PACE']
+        cols_display_ordered = [c for c in cols_prio + cols_geo + cols_prog_details if c in df_final_display.columns]
+        st.dataframe(df_final_display[cols_display_ordered], height=300)
+        col_formato, col_descarga = st.columns([1, 2], vertical_alignment='bottom')
+        formato_export = col_formato.selectbox("Formato de descarga:", list(FORMATOS_EXPORTACION), format_func=lambda f: FORMATOS_EXPORTACION[f][0], key='select_formato_export')
+        etiqueta_export, extension_export, mime_export = FORMATOS_EXPORTACION[formato_export]
+        # El archivo se genera sólo cuando se hace clic (data diferida) y queda en caché para esta combinación de filtros.
+        col_descarga.download_button(f"📊 Descargar Datos Visualizados ({etiqueta_export})",
+                                     data=lambda: exportar_datos(df_final_display, clave_filtros, formato_export),
+                                     file_name=f"datos_filtrados_mapa.{extension_export}", mime=mime_export, on_click='ignore', key='boton_descarga')
+    else:
+        if n_filtrados_widgets == 0 and st.session_state.data_loaded:
+            st.info("ℹ️ No hay establecimientos que coincidan con los filtros de la barra lateral.")
+        else:
+            st.info("ℹ️ No hay datos para mostrar. Ajusta filtros o carga un archivo.")
+
+# --- Callbacks de la barra lateral (corren antes del rerun, sin forzar uno adicional) ---
+WIDGETS_FILTRO = ['select_programas', 'select_dependencia', 'slider_matricula', 'input_radio_colegio']
+
+def resetear_filtros():
+    st.session_state.selected_programas = []; st.session_state.selected_dep = "Todos"; st.session_state.selected_mat_range = None
+    st.session_state.dibujos = []; st.session_state.radio_colegio_km = 0.0
+    for key in WIDGETS_FILTRO: st.session_state.pop(key, None)
+
+def limpiar_filtros():
+    print("\n--- ACCIÓN: Limpiando filtros sidebar y vista de mapa... ---")
+    resetear_filtros()
+    st.session_state.map_center = [DEFAULT_LAT, DEFAULT_LON]; st.session_state.map_zoom = DEFAULT_ZOOM; st.session_state.map_bounds = None
+    reiniciar_mapa()
+
+def borrar_dibujos():
+    print("\n--- ACCIÓN: Borrando dibujos del mapa ---")
+    st.session_state.dibujos = []; reiniciar_mapa()
 
 if 'initialized' not in st.session_state:
     print("\n--- INICIALIZANDO SESSION STATE POR PRIMERA VEZ ---")
     st.session_state.initialized = True
     st.session_state.map_center = [DEFAULT_LAT, DEFAULT_LON]
     st.session_state.map_zoom = DEFAULT_ZOOM
+    st.session_state.map_bounds = None
     st.session_state.data_loaded = False
     st.session_state.original_df_processed = None
+    st.session_state.dataset = None
+    st.session_state.densidad = None
+    st.session_state.jerarquia_clusters = None
+    st.session_state.indice_espacial = None
+    st.session_state.motor_filtros = None
+    st.session_state.dibujos = []
+    st.session_state.radio_colegio_km = 0.0
     st.session_state.selected_programas = []
     st.session_state.selected_dep = "Todos"
     st.session_state.selected_mat_range = None
     st.session_state.uploaded_filename = None
+    st.session_state.uploaded_file_id = None
+    st.session_state.uploaded_digest = None
+    st.session_state.perfilador = Perfilador()
+    st.session_state.mapa_version = 0
+    st.session_state.capa_datos = None
     print("--- SESSION STATE INICIALIZADO ---")
 
+if st.session_state.get('perfilador') is None: st.session_state.perfilador = Perfilador()
+st.session_state.perfilador.nuevo_rerun()
+
 st.sidebar.header("1. Cargar Datos")
-uploaded_file = st.sidebar.file_uploader("Sube tu archivo Excel", type=["xlsx", "xls"], key="file_uploader_main")
+uploaded_file = st.sidebar.file_uploader("Sube tu archivo (Excel, CSV o Parquet)", type=TIPOS_ARCHIVO, key="file_uploader_main",
+                                         help="CSV también comprimido (.csv.gz, .csv.zip, .csv.bz2, .csv.xz). Separador ';' o ','.")
 
 if st.session_state.data_loaded and st.session_state.uploaded_filename:
     st.sidebar.info(f"Archivo '{st.session_state.uploaded_filename}' activo.")
 
-if st.sidebar.button("♻️ Limpiar Filtros Sidebar", key="clear_button"):
-     print("\n--- ACCIÓN: Limpiando filtros sidebar y vista de mapa... ---")
-     st.session_state.selected_programas = []
-     st.session_state.selected_dep = "Todos"
-     st.session_state.selected_mat_range = None
-     st.session_state.map_center = [DEFAULT_LAT, DEFAULT_LON]
-     st.session_state.map_zoom = DEFAULT_ZOOM
-     print("--- ESTADO RESETEADO (sin dibujo). Disparando rerun. ---")
-     st.rerun()
+st.sidebar.button("♻️ Limpiar Filtros Sidebar", key="clear_button", on_click=limpiar_filtros)
 
 if uploaded_file is not None:
-    is_new_file = (not st.session_state.data_loaded or uploaded_file.name != st.session_state.get('uploaded_filename'))
+    # El digest se recalcula sólo cuando cambia la subida (file_id), no en cada rerun.
+    file_id = getattr(uploaded_file, 'file_id', None)
+    if file_id is None or file_id != st.session_state.get('uploaded_file_id'):
+        file_digest = calcular_digest(uploaded_file)
+    else:
+        file_digest = st.session_state.get('uploaded_digest')
+    is_new_file = (not st.session_state.data_loaded or file_digest != st.session_state.get('uploaded_digest'))
     if is_new_file:
-        print(f"\n--- DETECTADO NUEVO ARCHIVO: {uploaded_file.name}. Procesando... ---")
-        with st.spinner(f"Procesando '{uploaded_file.name}'..."): map_df_processed = load_and_process_data(uploaded_file)
-        if map_df_processed is not None and not map_df_processed.empty:
+        print(f"\n--- DETECTADO NUEVO ARCHIVO: {uploaded_file.name} ({file_digest[:12]}). Procesando... ---")
+        with st.spinner(f"Procesando '{uploaded_file.name}'..."), medir_etapa('carga') as medicion:
+            dataset = obtener_dataset(uploaded_file, file_digest)
+            if dataset is not None: medicion['filas'] = len(dataset.df)
+        if dataset is not None:
             print("--- NUEVO ARCHIVO PROCESADO OK. Reseteando estado app... ---")
-            st.session_state.original_df_processed = map_df_processed; st.session_state.data_loaded = True
+            # La sesión sólo guarda referencias al dataset compartido; nada de esto se copia.
+            st.session_state.dataset = dataset
+            st.session_state.original_df_processed = dataset.df; st.session_state.data_loaded = True
+            st.session_state.jerarquia_clusters = dataset.jerarquia_clusters
+            st.session_state.indice_espacial = dataset.indice_espacial
+            st.session_state.motor_filtros = dataset.motor_filtros
+            st.session_state.densidad = DensidadSeleccion(dataset.grilla_densidad)  # Agregados propios de la sesión
             st.session_state.uploaded_filename = uploaded_file.name
-            st.session_state.selected_programas = []; st.session_state.selected_dep = "Todos"; st.session_state.selected_mat_range = None
-            st.session_state.map_center = [DEFAULT_LAT, DEFAULT_LON]; st.session_state.map_zoom = DEFAULT_ZOOM
-            print("--- ESTADO APP RESETEADO (sin dibujo). Disparando rerun. ---")
-            st.rerun()
+            st.session_state.uploaded_file_id = file_id; st.session_state.uploaded_digest = file_digest
+            resetear_filtros()
+            st.session_state.map_center = [DEFAULT_LAT, DEFAULT_LON]; st.session_state.map_zoom = DEFAULT_ZOOM; st.session_state.map_bounds = None
+            reiniciar_mapa()
+            print("--- ESTADO APP RESETEADO (sin dibujo). Continuando con el nuevo archivo. ---")
         else:
             print(f"--- ERROR AL PROCESAR {uploaded_file.name} o sin datos válidos. ---")
             st.session_state.data_loaded = False; st.session_state.original_df_processed = None; st.session_state.uploaded_filename = None
+            st.session_state.uploaded_file_id = None; st.session_state.uploaded_digest = None
+            st.session_state.jerarquia_clusters = None; st.session_state.indice_espacial = None; st.session_state.motor_filtros = None
+            st.session_state.dataset = None; st.session_state.densidad = None
 
 if st.session_state.data_loaded and st.session_state.original_df_processed is not None:
-    map_df = st.session_state.original_df_processed.copy()
+    # Referencia de sólo lectura: los filtros trabajan con máscaras de filas y nunca copian el frame completo.
+    map_df = st.session_state.original_df_processed
+    motor_filtros = st.session_state.get('motor_filtros')
+    if motor_filtros is None or motor_filtros.n_filas != len(map_df):
+        motor_filtros = st.session_state.motor_filtros = MotorFiltros(map_df)
     st.success(f"Datos base listos: {len(map_df)} registros válidos.")
+    # Se toma la última vista y dibujos informados por el navegador (callback de st_folium con key=clave_mapa()) antes
+    # de filtrar y construir el mapa, para no trabajar con un viewport atrasado.
+    sincronizar_vista_mapa(st.session_state.get(clave_mapa()))
 
     st.sidebar.header("2. Filtrar Datos")
-    programas_disp = sorted(map_df['programa'].unique()) if 'programa' in map_df.columns else ['N/A']
+    programas_disp = motor_filtros.opciones_programa
     current_prog_selection = st.session_state.selected_programas
     if not current_prog_selection or not all(p in programas_disp for p in current_prog_selection): default_programas = programas_disp
     else: default_programas = current_prog_selection
-    selected_programas_new = st.sidebar.multiselect("Programa:", options=programas_disp, default=default_programas, key='select_programas')
-    if selected_programas_new != st.session_state.selected_programas:
-        print("\n--- CAMBIO DETECTADO: Filtro Programa ---")
-        st.session_state.selected_programas = selected_programas_new; st.rerun()
-    selected_programas = st.session_state.selected_programas
+    # Los widgets se leen directamente: el rerun que provoca su cambio ya trae el valor nuevo.
+    selected_programas = st.session_state.selected_programas = st.sidebar.multiselect("Programa:", options=programas_disp, default=default_programas, key='select_programas')
 
     selected_dep = "Todos"; deps_disp = ["Todos"]
     if 'COD_DEPE2' in map_df.columns:
-        deps_list = map_df['COD_DEPE2'].dropna().astype(str).unique()
-        try: deps_sorted = sorted(deps_list, key=lambda x: int(x) if x.isdigit() else float('inf'))
-        except ValueError: deps_sorted = sorted(deps_list)
-        deps_disp.extend(deps_sorted); current_selection = st.session_state.selected_dep
+        deps_disp.extend(motor_filtros.opciones_dependencia); current_selection = st.session_state.selected_dep
         if current_selection not in deps_disp: st.session_state.selected_dep = "Todos"; dep_index = 0
         else: dep_index = deps_disp.index(current_selection)
-        selected_dep_new = st.sidebar.selectbox("Dependencia (COD_DEPE2):", options=deps_disp, index=dep_index, key='select_dependencia')
-        if selected_dep_new != st.session_state.selected_dep:
-            print("\n--- CAMBIO DETECTADO: Filtro Dependencia ---")
-            st.session_state.selected_dep = selected_dep_new; st.rerun()
-        selected_dep = st.session_state.selected_dep
+        selected_dep = st.session_state.selected_dep = st.sidebar.selectbox("Dependencia (COD_DEPE2):", options=deps_disp, index=dep_index, key='select_dependencia')
     else: st.sidebar.text("'COD_DEPE2' no encontrado.")
 
     selected_mat_range = None
-    if 'MAT_TOTAL' in map_df.columns and map_df['MAT_TOTAL'].nunique() > 1:
-        min_mat, max_mat = int(map_df['MAT_TOTAL'].min()), int(map_df['MAT_TOTAL'].max())
+    rango_mat_disp = motor_filtros.rango_matricula
+    if rango_mat_disp is not None and rango_mat_disp[0] < rango_mat_disp[1]:
+        min_mat, max_mat = rango_mat_disp
         current_range = st.session_state.get('selected_mat_range')
         if current_range is None or not (isinstance(current_range, (tuple, list)) and len(current_range) == 2): default_range = (min_mat, max_mat)
         else: saved_min = max(min_mat, current_range[0]); saved_max = min(max_mat, current_range[1]); default_range = (min(saved_min, saved_max), max(saved_min, saved_max))
-        selected_mat_range_new = st.sidebar.slider("Matrícula Total:", min_value=min_mat, max_value=max_mat, value=default_range, key='slider_matricula')
-        if selected_mat_range_new != st.session_state.get('selected_mat_range'):
-             print("\n--- CAMBIO DETECTADO: Filtro Matrícula ---")
-             st.session_state.selected_mat_range = selected_mat_range_new; st.rerun()
-        selected_mat_range = st.session_state.selected_mat_range
-    elif 'MAT_TOTAL' in map_df.columns and not map_df['MAT_TOTAL'].empty:
-        unique_mat_val = int(map_df['MAT_TOTAL'].iloc[0]); st.sidebar.text(f"Matrícula Total: {unique_mat_val} (valor único)")
+        selected_mat_range = st.session_state.selected_mat_range = st.sidebar.slider("Matrícula Total:", min_value=min_mat, max_value=max_mat, value=default_range, key='slider_matricula')
+    elif rango_mat_disp is not None:
+        unique_mat_val = rango_mat_disp[0]; st.sidebar.text(f"Matrícula Total: {unique_mat_val} (valor único)")
         st.session_state.selected_mat_range = (unique_mat_val, unique_mat_val); selected_mat_range = st.session_state.selected_mat_range
     else: st.sidebar.text("'MAT_TOTAL' no encontrado.")
 
+    st.sidebar.subheader("Filtro Espacial")
+    st.session_state.radio_colegio_km = st.sidebar.number_input(f"Radio desde {COLEGIO_NOMBRE.title()} (km, 0 = sin filtro):", min_value=0.0, max_value=500.0,
+                                                                value=float(st.session_state.radio_colegio_km), step=0.5, key='input_radio_colegio')
+    if st.session_state.dibujos:
+        st.sidebar.text(f"Formas dibujadas en el mapa: {len(st.session_state.dibujos)}")
+        st.sidebar.button("🗑️ Borrar dibujos", key='borrar_dibujos_button', on_click=borrar_dibujos)
+    else: st.sidebar.caption("Dibuja un polígono, rectángulo o círculo en el mapa para filtrar por área.")
+
     with st.sidebar.expander("🐛 Estado Actual (Depuración)", expanded=False):
         st.write("**Vista Mapa:**")
         st.write(f"- Centro: `{st.session_state.get('map_center')}`")
         st.write(f"- Zoom: `{st.session_state.get('map_zoom')}`")
+        st.write(f"- Bounds: `{st.session_state.get('map_bounds')}`")
         st.write("**Otros:**")
         st.write(f"- Data Cargada: `{st.session_state.get('data_loaded')}`")
         st.write(f"- Archivo: `{st.session_state.get('uploaded_filename')}`")
+        dataset = st.session_state.get('dataset')
+        if dataset is not None: st.write(f"- Dataset compartido: `{dataset.digest[:12]}` ({dataset.memoria_mb:.1f} MB, una copia por proceso)")
         st.write(f"- Filtro Programa: `{st.session_state.get('selected_programas')}`")
         st.write(f"- Filtro Dep: `{st.session_state.get('selected_dep')}`")
         st.write(f"- Filtro Mat: `{st.session_state.get('selected_mat_range')}`")
+        st.write(f"- Radio Colegio (km): `{st.session_state.get('radio_colegio_km')}`")
+        st.write(f"- Dibujos: `{len(st.session_state.get('dibujos') or [])}`")
+        perfilado_activo = st.checkbox("⏱️ Perfilado por etapa", value=False, key='check_perfilado',
+                                       help="Tiempos, filas y tamaño del HTML del mapa por rerun. Medir el payload serializa el mapa una vez más.")
+        panel_perfilado = st.container()
 
-    df_filtered_widgets = map_df.copy()
-    if selected_programas: df_filtered_widgets = df_filtered_widgets[df_filtered_widgets['programa'].isin(selected_programas)]
-    if selected_dep != "Todos": df_filtered_widgets = df_filtered_widgets[df_filtered_widgets['COD_DEPE2'].astype(str) == selected_dep]
-    if selected_mat_range: df_filtered_widgets = df_filtered_widgets[(df_filtered_widgets['MAT_TOTAL'] >= selected_mat_range[0]) & (df_filtered_widgets['MAT_TOTAL'] <= selected_mat_range[1])]
+    inicio_filtros = time.perf_counter()
+    seleccion_widgets = motor_filtros.seleccionar(selected_programas, selected_dep, selected_mat_range)
+    n_filtrados_widgets = int(np.count_nonzero(seleccion_widgets))
 
-    st.sidebar.metric("Registros (Tras Filtros Sidebar)", len(df_filtered_widgets))
-    if len(df_filtered_widgets) > 15000:
+    st.sidebar.metric("Registros (Tras Filtros Sidebar)", n_filtrados_widgets)
+    agrupamiento = st.sidebar.radio("Agrupar puntos según zoom:", list(MODOS_AGRUPAMIENTO), format_func=MODOS_AGRUPAMIENTO.get, key='radio_agrupamiento',
+                                    help=f"Con más de {MAX_PUNTOS_INDIVIDUALES} puntos en pantalla se dibujan grupos o celdas de densidad (conteo, matrícula y programas); desde zoom {CLUSTER_MAX_ZOOM} siempre puntos individuales.")
+    if n_filtrados_widgets > 15000 and agrupamiento == 'ninguno':
         st.sidebar.warning("⚠️ >15k puntos sin agrupar. El mapa puede ser MUY LENTO o INESTABLE.")
-    elif len(df_filtered_widgets) == 0:
+    elif n_filtrados_widgets == 0:
         st.sidebar.warning("⚠️ 0 registros con filtros sidebar.")
 
-    df_final_display = df_filtered_widgets.copy()
-    print("\n--- Filtrado espacial DESHABILITADO. Mostrando datos filtrados solo por sidebar. ---")
-
-    st.header("3. Mapa Interactivo")
-    st.info(f"✨ Mostrando {len(df_final_display)} registros según filtros de sidebar. Marcadores individuales (sin agrupar).")
-
-    m = folium.Map(location=st.session_state.get('map_center', [DEFAULT_LAT, DEFAULT_LON]),
-                   zoom_start=st.session_state.get('map_zoom', DEFAULT_ZOOM),
-                   tiles='OpenStreetMap', control_scale=True)
+    seleccion_final = seleccion_widgets
+    indice_espacial = st.session_state.get('indice_espacial')
+    if indice_espacial is not None and (st.session_state.dibujos or st.session_state.radio_colegio_km > 0):
+        seleccion_final = seleccion_widgets.copy()
+        if st.session_state.dibujos:
+            en_dibujos = np.zeros(len(indice_espacial), dtype=bool); en_dibujos[indice_espacial.en_dibujos(st.session_state.dibujos)] = True
+            seleccion_final &= en_dibujos
+        if st.session_state.radio_colegio_km > 0:
+            en_radio = np.zeros(len(indice_espacial), dtype=bool); en_radio[indice_espacial.en_circulo(COLEGIO_LAT, COLEGIO_LON, st.session_state.radio_colegio_km)] = True
+            seleccion_final &= en_radio
+        print(f"\n--- Filtro espacial aplicado: {int(np.count_nonzero(seleccion_final))} de {n_filtrados_widgets} registros. ---")
+    # Único punto donde se materializan filas: sólo las seleccionadas, para el mapa y la tabla.
+    df_final_display = map_df[seleccion_final]
+    densidad = st.session_state.get('densidad')
+    if densidad is None or densidad.grilla.n_filas != len(map_df):
+        densidad = st.session_state.densidad = DensidadSeleccion(GrillaDensidad(map_df, st.session_state.get('jerarquia_clusters')))
+    densidad.actualizar(seleccion_final)  # Incremental: sólo suma/resta las filas que cambiaron de estado
+    registrar_etapa('filtros', inicio_filtros, filas=len(df_final_display))
 
-    folium.Marker(
-        location=[COLEGIO_LAT, COLEGIO_LON],
-        tooltip=html.escape(COLEGIO_NOMBRE),
-        popup=f"<b>{html.escape(COLEGIO_NOMBRE)}</b>",
-        icon=folium.Icon(color='darkblue', icon_color='white', icon='school', prefix='fa')
-    ).add_to(m)
+    clave_filtros = clave_estado_filtros(st.session_state.get('uploaded_digest'), selected_programas, selected_dep, selected_mat_range,
+                                         st.session_state.dibujos, st.session_state.radio_colegio_km)
 
-    if not df_final_display.empty:
-        points_added_count = 0
-        for idx, r in df_final_display.iterrows():
-            try:
-                prog = r.get('programa', 'N/A'); clr = COLORS.get(prog, DEFAULT_COLOR); popup_html = crear_popup_html(r, clr)
-                popup_obj = folium.Popup(popup_html, max_width=400)
-                
-                mat_total_val = r.get('MAT_TOTAL', 0)
-                
-                # --- ### CAMBIO REQUERIDO: Nueva lógica para calcular el radio ---
-                if mat_total_val > 0:
-                    calculated_radius = (
-                        MARKER_BASE_SIZE_CALC + 
-                        (mat_total_val**MARKER_EXPONENT_CALC) / MARKER_DIVISOR_CALC
-                    )
-                    radius = max(MARKER_MIN_RADIUS, min(MARKER_MAX_RADIUS, calculated_radius))
-                else:
-                    radius = MARKER_MIN_RADIUS
-                # --- FIN CAMBIO REQUERIDO ---
-                
-                nom_rbd_raw = str(r.get('NOM_RBD', 'N/A')); rbd_val_raw = str(r.get('RBD', 'N/A')); nom_rbd_html_safe = html.escape(nom_rbd_raw)
-                nom_rbd_js_safe = nom_rbd_html_safe.replace('\\', '\\\\').replace('`', '\\`').replace('${', '\\${').replace("'", "\\'")
-                tooltip_text = f"{nom_rbd_js_safe} (RBD: {rbd_val_raw})"
-
-                folium.CircleMarker(
-                    location=[r['LATITUD'], r['LONGITUD']],
-                    radius=radius, # Usar el nuevo radio calculado
-                    color='#333333',
-                    weight=0.5,
-                    fill=True,
-                    fill_color=clr,
-                    fill_opacity=0.7,
-                    popup=popup_obj,
-                    tooltip=tooltip_text
-                ).add_to(m)
-                points_added_count += 1
-            except Exception as e_marker:
-                rbd_err = r.get('RBD', 'DESCONOCIDO');
-                print(f"ERROR al crear marcador para RBD {rbd_err}: {e_marker} - Datos fila: {r.to_dict()}")
-
-    #draw = Draw(export=False, filename='dibujo.geojson', position='topleft', draw_options={'polyline': False, 'polygon': {'showArea': True, 'metric': True, 'feet': False}, 'circle': {'showRadius': True, 'metric': True, 'feet': False}, 'rectangle': {'showArea': True, 'metric': True, 'feet': False}, 'marker': False, 'circlemarker': False}, edit_options={'edit': False, 'remove': False }).add_to(m)
-
-    print("Renderizando mapa con st_folium...")
-    map_output = st_folium(m, key="map1", width='100%', height=600, returned_objects=["map_center", "map_zoom"])
-    print("Mapa renderizado.")
-
-    if map_output:
-        new_center = map_output.get("map_center")
-        if new_center and isinstance(new_center, list) and len(new_center) == 2:
-            if new_center != st.session_state.map_center:
-                st.session_state.map_center = new_center
-        elif new_center: print(f"WARN: map_center recibido de st_folium no es válido: {new_center}")
-
-        new_zoom = map_output.get("map_zoom")
-        if new_zoom and isinstance(new_zoom, (int, float)):
-             if new_zoom != st.session_state.map_zoom:
-                 st.session_state.map_zoom = new_zoom
-        elif new_zoom: print(f"WARN: map_zoom recibido de st_folium no es válido: {new_zoom}")
-
-        print("\n--- ESTADO DESPUÉS DE INTERACCIÓN MAPA ---")
-        print(f"Centro Actual en State: {st.session_state.get('map_center')}")
-        print(f"Zoom Actual en State: {st.session_state.get('map_zoom')}")
-        print("--- FIN ESTADO DESPUÉS DE INTERACCIÓN ---\n")
-        print(f"Fin del bloque map_output. Solo se actualizó centro/zoom si cambiaron.")
+    st.header("3. Mapa Interactivo")
+    mostrar_mapa(df_final_display, clave_filtros, agrupamiento, perfilado_activo)
+    mostrar_tabla(df_final_display, clave_filtros, n_filtrados_widgets)
 
-    st.header("4. Datos Filtrados para Visualización")
-    st.metric("Registros Mostrados en Mapa", len(df_final_display))
-    if not df_final_display.empty:
-        cols_prio = ['RBD', 'NOM_RBD', 'programa', 'MAT_TOTAL', 'COD_DEPE', 'COD_DEPE2']; cols_geo = ['LATITUD', 'LONGITUD']; cols_prog_details = ['CONVENIO_PIE', 'PACE']
-        cols_display_ordered = [c for c in cols_prio + cols_geo + cols_prog_details if c in df_final_display.columns]
-        st.dataframe(df_final_display[cols_display_ordered], height=300)
-        st.markdown(get_table_download_link(df_final_display, "datos_filtrados_mapa.xlsx", "📊 Descargar Datos Visualizados (Excel)"), unsafe_allow_html=True)
-    else:
-        if len(df_filtered_widgets) == 0 and st.session_state.data_loaded:
-            st.info("ℹ️ No hay establecimientos que coincidan con los filtros de la barra lateral.")
-        else:
-            st.info("ℹ️ No hay datos para mostrar. Ajusta filtros o carga un archivo.")
+    st.session_state.perfilador.cerrar_rerun()
+    if perfilado_activo: mostrar_panel_perfilado(panel_perfilado, st.session_state.perfilador)
 
 elif not st.session_state.data_loaded:
-    st.info("👈 Sube un archivo Excel en la barra lateral para comenzar.")
+    st.info("👈 Sube un archivo Excel, CSV o Parquet en la barra lateral para comenzar.")
 
 print("--- Fin de la ejecución del script ---")
\ No newline at end of file
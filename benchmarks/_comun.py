@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""Utilidades compartidas por los benchmarks: importación de app.py y datos sintéticos."""
+import logging
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def importar_app():
+    # app.py es un script de Streamlit; importarlo fuera de `streamlit run` lo ejecuta en modo "bare".
+    # Se silencian los avisos de Streamlit por no tener ScriptRunContext.
+    logging.disable(logging.WARNING)
+    import app
+    return app
+
+
+def datos_sinteticos(n_filas, semilla=0):
+    """Frame con la forma que deja load_and_process_data, con coordenadas repartidas por Chile."""
+    rng = np.random.default_rng(semilla)
+    pie = rng.integers(0, 2, n_filas); pace = rng.integers(0, 2, n_filas)
+    programa = np.select([(pie == 1) & (pace == 1), pie == 1, pace == 1], ['PIE y PACE', 'PIE', 'PACE'], 'Otros')
+    df = pd.DataFrame({
+        'RBD': np.arange(1, n_filas + 1),
+        'NOM_RBD': [f"ESCUELA BÁSICA N° {i}" for i in range(n_filas)],
+        'COD_DEPE': rng.integers(1, 7, n_filas),
+        'COD_DEPE2': rng.integers(1, 6, n_filas),
+        'CONVENIO_PIE': pie,
+        'PACE': pace,
+        'MAT_TOTAL': rng.integers(0, 2500, n_filas),
+        'LATITUD': rng.uniform(-45.0, -18.5, n_filas),
+        'LONGITUD': rng.uniform(-73.5, -68.5, n_filas),
+        'programa': programa,
+    })
+    for i in range(1, 7):
+        df[f'ENS_0{i}'] = rng.choice(['0', '110', '310', '410', '510'], n_filas)
+    return df
+
+
+def cronometrar(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    resultado = fn(*args, **kwargs)
+    return resultado, time.perf_counter() - t0
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+"""Compara los agregados por celda con groupby (agrupar_clusters) contra GrillaDensidad/DensidadSeleccion,
+recalculando desde cero y con actualización incremental tras un cambio de filtro pequeño.
+
+Uso: python benchmarks/bench_densidad.py [--filas 50000 200000] [--zoom 6]
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from _comun import cronometrar, datos_sinteticos, importar_app
+
+app = importar_app()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filas', type=int, nargs='+', default=[50000, 200000])
+    parser.add_argument('--zoom', type=int, default=6)
+    args = parser.parse_args()
+
+    print(f"{'filas':>8} {'celdas':>7} {'precálculo (ms)':>16} {'groupby (ms)':>13} {'bincount (ms)':>14} {'incremental (ms)':>17}")
+    for n in args.filas:
+        df = datos_sinteticos(n); df['programa'] = pd.Categorical(df['programa'])
+        jerarquia = app.construir_jerarquia_clusters(df)
+        grilla, t_pre = cronometrar(app.GrillaDensidad, df, jerarquia)
+        rng = np.random.default_rng(2)
+        mascara = rng.random(n) < 0.6
+        # Cambio típico de filtro: una dependencia o un tramo de matrícula que entra o sale (~2% de las filas).
+        mascara_nueva = mascara ^ (rng.random(n) < 0.02)
+
+        _, t_groupby = cronometrar(app.agrupar_clusters, df[mascara_nueva], jerarquia, args.zoom)
+        tabla, t_bincount = cronometrar(grilla.agregar, args.zoom, np.flatnonzero(mascara_nueva))
+        seleccion = app.DensidadSeleccion(grilla); seleccion.actualizar(mascara); seleccion.en_zoom(args.zoom)
+        _, t_incremental = cronometrar(seleccion.actualizar, mascara_nueva)
+        assert np.allclose(seleccion.en_zoom(args.zoom), tabla), "el agregado incremental no coincide con el recálculo"
+        celdas = int(np.count_nonzero(tabla[:, 0]))
+        print(f"{n:>8} {celdas:>7} {t_pre * 1e3:>16.1f} {t_groupby * 1e3:>13.1f} {t_bincount * 1e3:>14.1f} {t_incremental * 1e3:>17.1f}")
+
+
+if __name__ == '__main__':
+    main()
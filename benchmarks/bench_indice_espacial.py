@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Mide las consultas de IndiceEspacial contra un barrido completo (haversine / ray casting sobre todas las filas).
+
+Uso: python benchmarks/bench_indice_espacial.py [--filas 50000] [--repeticiones 200]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from _comun import cronometrar, datos_sinteticos, importar_app
+
+app = importar_app()
+
+# Polígono aproximado de la Región Metropolitana ([lon, lat], orden GeoJSON).
+POLIGONO_RM = [[-71.2, -33.0], [-70.3, -33.0], [-70.2, -33.8], [-70.9, -34.2], [-71.4, -33.7], [-71.2, -33.0]]
+
+
+def barrido_circulo(lat, lon, lat_c, lon_c, radio_km):
+    return np.flatnonzero(app.distancia_haversine_km(lat, lon, lat_c, lon_c) <= radio_km)
+
+
+def barrido_rectangulo(lat, lon, sur, oeste, norte, este):
+    return np.flatnonzero((lat >= sur) & (lat <= norte) & (lon >= oeste) & (lon <= este))
+
+
+def barrido_poligono(lat, lon, anillo):
+    return np.flatnonzero(app._puntos_en_anillo(lat, lon, anillo))
+
+
+def promedio_us(fn, repeticiones):
+    t0 = time.perf_counter()
+    for _ in range(repeticiones): resultado = fn()
+    return resultado, (time.perf_counter() - t0) / repeticiones * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filas', type=int, default=50000)
+    parser.add_argument('--repeticiones', type=int, default=200)
+    args = parser.parse_args()
+
+    df = datos_sinteticos(args.filas)
+    # Concentra un tercio de los puntos en Santiago, como en el archivo nacional.
+    n_stgo = args.filas // 3
+    rng = np.random.default_rng(1)
+    df.loc[:n_stgo - 1, 'LATITUD'] = rng.normal(app.COLEGIO_LAT, 0.15, n_stgo)
+    df.loc[:n_stgo - 1, 'LONGITUD'] = rng.normal(app.COLEGIO_LON, 0.15, n_stgo)
+    lat = df['LATITUD'].to_numpy(); lon = df['LONGITUD'].to_numpy()
+
+    indice, t_build = cronometrar(app.IndiceEspacial, lat, lon)
+    print(f"{args.filas} puntos. Construcción del índice: {t_build * 1e3:.1f} ms\n")
+    consultas = [
+        ("rectángulo 0.2°", lambda: indice.en_rectangulo(-33.6, -70.75, -33.4, -70.55), lambda: barrido_rectangulo(lat, lon, -33.6, -70.75, -33.4, -70.55)),
+        ("círculo 2 km", lambda: indice.en_circulo(app.COLEGIO_LAT, app.COLEGIO_LON, 2), lambda: barrido_circulo(lat, lon, app.COLEGIO_LAT, app.COLEGIO_LON, 2)),
+        ("colegio 10 km", lambda: indice.en_circulo(app.COLEGIO_LAT, app.COLEGIO_LON, 10), lambda: barrido_circulo(lat, lon, app.COLEGIO_LAT, app.COLEGIO_LON, 10)),
+        ("polígono RM", lambda: indice.en_poligono([POLIGONO_RM]), lambda: barrido_poligono(lat, lon, POLIGONO_RM)),
+    ]
+    print(f"{'consulta':<18} {'resultados':>10} {'índice (µs)':>12} {'barrido (µs)':>13} {'aceleración':>12}")
+    for nombre, con_indice, barrido in consultas:
+        r_indice, us_indice = promedio_us(con_indice, args.repeticiones)
+        r_barrido, us_barrido = promedio_us(barrido, max(1, args.repeticiones // 10))
+        assert np.array_equal(r_indice, r_barrido), f"{nombre}: el índice no coincide con el barrido"
+        print(f"{nombre:<18} {len(r_indice):>10} {us_indice:>12.1f} {us_barrido:>13.1f} {us_barrido / us_indice:>11.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Compara la lectura actual (pd.read_excel de todas las columnas) con leer_archivo_establecimientos en cada formato.
+
+Genera un archivo ancho como los del Mineduc (columnas de interés + muchas columnas extra) y reporta tiempo y
+memoria máxima asignada por Python (tracemalloc; no incluye la memoria interna de motores nativos como calamine).
+
+Uso: python benchmarks/bench_ingesta.py [--filas 16000] [--columnas-extra 150] [--dir /tmp/bench_ingesta]
+"""
+import argparse
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from _comun import datos_sinteticos, importar_app
+
+app = importar_app()
+
+
+def generar_archivos(directorio, n_filas, n_extra):
+    base = datos_sinteticos(n_filas).drop(columns=['programa'])
+    rng = np.random.default_rng(2)
+    extra = pd.DataFrame(rng.integers(0, 1000, (n_filas, n_extra)), columns=[f'EXTRA_{i:03d}' for i in range(n_extra)])
+    df = pd.concat([extra.iloc[:, :n_extra // 2], base, extra.iloc[:, n_extra // 2:]], axis=1)
+    rutas = {fmt: os.path.join(directorio, f'establecimientos.{fmt}') for fmt in ('xlsx', 'csv', 'csv.gz', 'parquet')}
+    if not os.path.exists(rutas['xlsx']):
+        print(f"Generando {rutas['xlsx']} ({n_filas} filas x {len(df.columns)} columnas)...")
+        with pd.ExcelWriter(rutas['xlsx'], engine='openpyxl') as writer: df.to_excel(writer, index=False)
+    if not os.path.exists(rutas['csv']): df.to_csv(rutas['csv'], sep=';', decimal=',', index=False)
+    if not os.path.exists(rutas['csv.gz']):
+        with open(rutas['csv'], 'rb') as f, gzip.open(rutas['csv.gz'], 'wb') as g: shutil.copyfileobj(f, g)
+    if not os.path.exists(rutas['parquet']): df.to_parquet(rutas['parquet'], index=False)
+    return rutas
+
+
+def lectura_actual(ruta):
+    # Camino anterior: todo el libro por openpyxl y recién después se recorta a COLS_INTERES.
+    df = pd.read_excel(ruta)
+    return df[[c for c in app.COLS_INTERES if c in df.columns]].copy()
+
+
+def medir(fn, ruta):
+    with open(ruta, 'rb') as f:
+        t0 = time.perf_counter(); df = fn(f); t = time.perf_counter() - t0
+    with open(ruta, 'rb') as f:
+        tracemalloc.start(); fn(f); _, pico = tracemalloc.get_traced_memory(); tracemalloc.stop()
+    return df, t, pico
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filas', type=int, default=16000)
+    parser.add_argument('--columnas-extra', type=int, default=150)
+    parser.add_argument('--dir', default=os.path.join(tempfile.gettempdir(), 'bench_ingesta'))
+    args = parser.parse_args()
+    os.makedirs(args.dir, exist_ok=True)
+    rutas = generar_archivos(args.dir, args.filas, args.columnas_extra)
+
+    casos = [
+        ('xlsx', 'pd.read_excel (actual)', lectura_actual),
+        ('xlsx', 'streaming openpyxl', lambda f: app.leer_archivo_establecimientos(f, 'x.xlsx', motor_excel='openpyxl')),
+    ]
+    if app.MOTOR_EXCEL_RAPIDO_DISPONIBLE:
+        casos.append(('xlsx', 'streaming calamine', lambda f: app.leer_archivo_establecimientos(f, 'x.xlsx', motor_excel='calamine')))
+    casos += [
+        ('csv', 'csv (;)', lambda f: app.leer_archivo_establecimientos(f, 'x.csv')),
+        ('csv.gz', 'csv.gz', lambda f: app.leer_archivo_establecimientos(f, 'x.csv.gz')),
+        ('parquet', 'parquet', lambda f: app.leer_archivo_establecimientos(f, 'x.parquet')),
+    ]
+    print(f"\n{'camino':<24} {'archivo (MB)':>12} {'tiempo (s)':>11} {'pico mem (MB)':>14} {'filas':>7} {'cols':>5}")
+    for fmt, nombre, fn in casos:
+        df, t, pico = medir(fn, rutas[fmt])
+        print(f"{nombre:<24} {os.path.getsize(rutas[fmt]) / 1e6:>12.1f} {t:>11.2f} {pico / 1e6:>14.1f} {len(df):>7} {len(df.columns):>5}")
+
+
+if __name__ == '__main__':
+    main()
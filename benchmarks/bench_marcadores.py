@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Compara el loop por fila (iterrows + un CircleMarker por colegio) con la capa GeoJSON vectorizada,
+con popups embebidos o diferidos (armados en el navegador al hacer clic).
+
+Uso: python benchmarks/bench_marcadores.py [--filas 1000 10000 50000] [--sin-legado]
+"""
+import argparse
+import html
+
+import folium
+import pandas as pd
+
+from _comun import cronometrar, datos_sinteticos, importar_app
+
+app = importar_app()
+
+
+def _mapa_base():
+    return folium.Map(location=[app.DEFAULT_LAT, app.DEFAULT_LON], zoom_start=app.DEFAULT_ZOOM, tiles='OpenStreetMap', control_scale=True)
+
+
+def _popup_html_por_fila(r, clr):
+    # Réplica del antiguo crear_popup_html escalar (estilos abreviados), sólo como referencia.
+    rbd_val = r.get('RBD', 'N/A'); nom_rbd_safe = html.escape(str(r.get('NOM_RBD', 'N/A')))
+    cod_depe_safe = html.escape(str(r.get('COD_DEPE', 'N/A'))); cod_depe2_safe = html.escape(str(r.get('COD_DEPE2', 'N/A')))
+    pie = r.get('CONVENIO_PIE', 0); pie_str = "Sí" if pie == 1 else "No"
+    pace = r.get('PACE', 0); pace_str = "Sí" if pace == 1 else "No"
+    ens_activas = [f"0{i}" for i in range(1, 7) if f'ENS_0{i}' in r and pd.notna(r[f'ENS_0{i}']) and str(r[f'ENS_0{i}']).strip() not in ['0', 'N/A', '', ' ']]
+    ens_str_safe = html.escape(", ".join(ens_activas) if ens_activas else "Ninguna (01-06)")
+    mat_total_safe = html.escape(str(r.get('MAT_TOTAL', 0)))
+    return f"""<div style="width: 350px; font-family: {app.FONT_FAMILY};"><div style="background: {clr}; color: white;"><strong>{nom_rbd_safe}</strong><span>RBD: {rbd_val}</span></div><div><p><strong>Dependencia (1/2):</strong> {cod_depe_safe} / {cod_depe2_safe}</p><p><strong>PIE:</strong> {pie_str}</p><p><strong>PACE:</strong> {pace_str}</p><p><strong>Matrícula Total:</strong> {mat_total_safe}</p><p><strong>Enseñanzas Activas (01-06):</strong><br>{ens_str_safe}</p></div></div>"""
+
+
+def marcadores_por_fila(df):
+    # Reproduce el camino anterior: un folium.CircleMarker + folium.Popup por fila, con matemática escalar.
+    m = _mapa_base()
+    for _, r in df.iterrows():
+        clr = app.COLORS.get(r.get('programa', 'N/A'), app.DEFAULT_COLOR)
+        popup_obj = folium.Popup(_popup_html_por_fila(r, clr), max_width=400)
+        mat_total_val = r.get('MAT_TOTAL', 0)
+        if mat_total_val > 0:
+            radius = max(app.MARKER_MIN_RADIUS, min(app.MARKER_MAX_RADIUS, app.MARKER_BASE_SIZE_CALC + (mat_total_val**app.MARKER_EXPONENT_CALC) / app.MARKER_DIVISOR_CALC))
+        else:
+            radius = app.MARKER_MIN_RADIUS
+        tooltip_text = f"{html.escape(str(r.get('NOM_RBD', 'N/A')))} (RBD: {r.get('RBD', 'N/A')})"
+        folium.CircleMarker(location=[r['LATITUD'], r['LONGITUD']], radius=radius, color='#333333', weight=0.5, fill=True,
+                            fill_color=clr, fill_opacity=0.7, popup=popup_obj, tooltip=tooltip_text).add_to(m)
+    return m
+
+
+def marcadores_embebidos(df):
+    m = _mapa_base()
+    app.construir_capa_marcadores(df, popups_diferidos=False).add_to(m)
+    return m
+
+
+def marcadores_diferidos(df):
+    m = _mapa_base()
+    app.construir_capa_marcadores(df, popups_diferidos=True).add_to(m)
+    return m
+
+
+def medir(constructor, df):
+    m, t_build = cronometrar(constructor, df)
+    html_mapa, t_render = cronometrar(lambda: m.get_root().render())
+    return t_build, t_render, len(html_mapa.encode('utf-8'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filas', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--sin-legado', action='store_true', help="Omite el camino por fila (lento con muchas filas).")
+    args = parser.parse_args()
+
+    print(f"{'filas':>8} {'camino':<14} {'build (s)':>10} {'render (s)':>11} {'total (s)':>10} {'HTML (MB)':>10}")
+    for n in args.filas:
+        df = datos_sinteticos(n)
+        caminos = [('embebidos', marcadores_embebidos), ('diferidos', marcadores_diferidos)]
+        if not args.sin_legado: caminos.insert(0, ('por fila', marcadores_por_fila))
+        for nombre, constructor in caminos:
+            t_build, t_render, peso = medir(constructor, df)
+            print(f"{n:>8} {nombre:<14} {t_build:>10.3f} {t_render:>11.3f} {t_build + t_render:>10.3f} {peso / 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()